@@ -1,29 +1,178 @@
 """Flask App for Flask Cafe."""
 
-
-from flask import Flask, render_template, request, flash
-from flask import redirect, session, g, jsonify, Response
-from flask_debugtoolbar import DebugToolbarExtension
-
-from models import db, connect_db, Cafe, City, User, Like
+import json
+from datetime import datetime, timezone
+from functools import wraps
+
+import os
+
+from flask import Flask, Blueprint, render_template, request, flash
+from flask import redirect, session, g, jsonify, Response, abort
+from flask import make_response, stream_with_context, current_app
+from flask import send_file
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from models import db, connect_db, Cafe, City, User, Like, UserIdentity
+from models import DataVersion, PAGES_VERSION, SimilarCafe
+from models import decode_cursor, city_registry
+from models import CityRegistry, UsernameIndex
+from cache import LRUCache, PageCache
+from config import CONFIGS
+from dbrouting import use_replica
+from hashing import HashingBusy
+from ratelimit import RateLimiter
+import assets
+import instrumentation
+import metrics
+import profiling
+import thumbnails
+from instrumentation import query_budget
+from metrics import registry
+from profiling import profile_store
+from thumbnails import thumbnailer
+from leaderboard import Leaderboard, leaderboard
 from forms import CafeForm, SignupForm, LoginForm, ProfileEditForm
+from importer import import_cafes_command
+from maintenance import reconcile_like_counts_command, upgrade_db_command
+from recommendations import refresh_similar_cafes_command
+from assets import build_assets_command
 
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 
-from secrets import FLASK_SECRET_KEY
 
+bp = Blueprint('main', __name__)
+
+# the current app's identities of logged-in users, keyed by user id
+user_cache = LocalProxy(lambda: current_app.extensions['user_cache'])
+
+# the current app's rendered cafe pages for anonymous users
+page_cache = LocalProxy(lambda: current_app.extensions['page_cache'])
+
+cache_lookups = registry.counter(
+    'flaskcafe_cache_lookups_total',
+    'Cache lookups, by cache and whether they hit.',
+    ['cache', 'result'])
+
+likes_total = registry.counter(
+    'flaskcafe_likes_total',
+    'Cafes liked and unliked.',
+    ['action'])
+
+
+def rate_limit_keys():
+    """Rate limit clients by IP and, if logged in, by user."""
+
+    keys = [f"ip:{request.remote_addr}"]
+    if CURR_USER_KEY in session:
+        keys.append(f"user:{session[CURR_USER_KEY]}")
+    return keys
+
+
+rate_limiter = RateLimiter(rate_limit_keys)
+
+
+def create_app(config=None):
+    """Create and configure a Flask Cafe app.
+
+    config is a config class or the name of one in config.CONFIGS; by
+    default, named by the FLASK_CONFIG environment variable (falling back
+    to production, so a deployment that forgets it never runs with
+    development's debug mode and public secret key).
+    """
+
+    if config is None:
+        config = os.environ.get('FLASK_CONFIG', 'production')
+    if isinstance(config, str):
+        config = CONFIGS[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError("FLASK_SECRET_KEY must be set")
+
+    # behind proxies, take the client's address (and scheme) from them,
+    # so e.g. rate limits are per client, not per proxy
+    if app.config['PROXY_FIX_X_FOR'] or app.config['PROXY_FIX_X_PROTO']:
+        app.wsgi_app = ProxyFix(
+            app.wsgi_app,
+            x_for=app.config['PROXY_FIX_X_FOR'],
+            x_proto=app.config['PROXY_FIX_X_PROTO'],
+        )
+
+    # only pay for the toolbar (and importing it) where it's wanted
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+
+    # caches and other in-process state belong to the app, so making
+    # another app (e.g. in tests) leaves this one alone
+    app.extensions['user_cache'] = LRUCache(
+        maxsize=app.config['USER_CACHE_SIZE'],
+        ttl=app.config['USER_CACHE_TTL'],
+    )
+    app.extensions['page_cache'] = PageCache(
+        maxsize=app.config['PAGE_CACHE_SIZE'],
+        ttl=app.config['PAGE_CACHE_TTL'],
+    )
+    app.extensions['city_registry'] = CityRegistry()
+    app.extensions['username_index'] = UsernameIndex()
+    app.extensions['leaderboard'] = Leaderboard(
+        size=app.config['LEADERBOARD_SIZE'],
+        headroom=app.config['LEADERBOARD_HEADROOM'],
+        max_age=app.config['LEADERBOARD_MAX_AGE'],
+    )
+    rate_limiter.init_app(app)
+
+    instrumentation.init_app(app)
+    metrics.init_app(app, db)
+    profiling.init_app(app)
+    thumbnails.init_app(app)
+    assets.init_app(app)
+    app.register_blueprint(bp)
+    app.register_error_handler(HashingBusy, hashing_busy)
+    app.cli.add_command(import_cafes_command)
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(reconcile_like_counts_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(refresh_similar_cafes_command)
+
+    return app
+
+
+# PAGES_VERSION is bumped in the transaction of any cafe or city write,
+# so once that commits, no process serves older pages
+
+
+@event.listens_for(db.session, 'after_flush')
+def _bump_pages_version_after_flush(session, flush_context):
+    """Expire cached pages if any cafe or city was written in this flush."""
 
-app = Flask(__name__)
+    written = session.new | session.dirty | session.deleted
+    if any(isinstance(obj, (Cafe, City)) for obj in written):
+        DataVersion.bump(PAGES_VERSION, session)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres:///flaskcafe'
-app.config['SECRET_KEY'] = FLASK_SECRET_KEY
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 
-toolbar = DebugToolbarExtension(app)
+@event.listens_for(db.session, 'after_bulk_update')
+@event.listens_for(db.session, 'after_bulk_delete')
+def _bump_pages_version_after_bulk(context):
+    """Expire cached pages after a bulk update/delete of cafes or cities."""
 
-connect_db(app)
+    if context.mapper.class_ in (Cafe, City):
+        DataVersion.bump(PAGES_VERSION, context.session)
+
+
+def hashing_busy(error):
+    """Reject request fast when password hashing is at capacity."""
+
+    return Response(
+        'Too many logins in progress; please try again shortly.',
+        503,
+        {'Retry-After': '1'})
 
 
 #######################################
@@ -33,16 +182,30 @@ CURR_USER_KEY = "curr_user"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = get_user_identity(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+def get_user_identity(user_id):
+    """Return (cached) UserIdentity for user_id, or None if no such user."""
+
+    identity = user_cache.get(user_id)
+    cache_lookups.labels('user', 'miss' if identity is None else 'hit').inc()
+
+    if identity is None:
+        identity = UserIdentity.get(user_id)
+        if identity is not None:
+            user_cache.set(user_id, identity)
+
+    return identity
+
+
 def do_login(user):
     """Log in user."""
     # print("do_login app.py")
@@ -56,7 +219,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route("/signup", methods=["GET", "POST"])
+@bp.route("/signup", methods=["GET", "POST"])
 def register_account():
     """Show signup form and process registration."""
 
@@ -71,6 +234,11 @@ def register_account():
         password = form.password.data
         image_url = form.image_url.data
 
+        # cheap check first, so a taken username doesn't cost a bcrypt hash
+        if User.username_taken(username):
+            flash("Username already taken.")
+            return render_template('auth/signup-form.html', form=form)
+
         new_user = User.register(
             username,
             first_name,
@@ -83,10 +251,8 @@ def register_account():
 
         db.session.add(new_user)
 
-        # put this in a try/ except IntegrityError
-        # render the form again with an error message of "username already taken"
+        # still possible if someone else took the username meanwhile
         try:
-            
             db.session.commit()
             do_login(new_user)
 
@@ -94,8 +260,9 @@ def register_account():
             return redirect(f'/cafes')
 
         except IntegrityError:
+            db.session.rollback()
             flash("Username already taken.")
-            render_template('auth/signup-form.html', form=form)
+            return render_template('auth/signup-form.html', form=form)
 
 
     return render_template(
@@ -103,7 +270,22 @@ def register_account():
     )
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/api/username-available")
+def username_available():
+    """Return JSON {username, available} for live signup form checks."""
+
+    username = request.args.get("username", "").strip()
+    if not username:
+        return jsonify({"error": "Missing username"}), 400
+
+    return jsonify({
+        "username": username,
+        "available": not User.username_taken(username),
+    })
+
+
+@bp.route("/login", methods=["GET", "POST"])
+@rate_limiter.limit("login")
 def login():
     """Show signup form and process registration."""
 
@@ -116,6 +298,8 @@ def login():
         user = User.authenticate(username, password)
 
         if user:
+            # save password hash if authenticate upgraded it
+            db.session.commit()
             do_login(user)
             flash(f'Hello, {username}')
             return redirect(f'/cafes')
@@ -126,7 +310,7 @@ def login():
     return render_template('auth/login-form.html', form=form)
 
 
-@app.route("/logout", methods=["POST"])
+@bp.route("/logout", methods=["POST"])
 def logout():
     """Logs user out and redirects to homepage."""
 
@@ -138,66 +322,301 @@ def logout():
 #######################################
 # homepage
 
-@app.route("/")
+@bp.route("/")
 def homepage():
     """Show homepage."""
 
-    return render_template("homepage.html")
+    return render_template("homepage.html", **top_cafes())
 
 
 #######################################
 # cafes
 
 
-@app.route('/cafes')
+def top_cafes():
+    """Return template context for cafe/_top.html: the most liked cafes
+    overall and in the `city` query param's city, or else in the
+    TOP_CITIES_SHOWN cities with the most liked cafes.
+
+    (Every city's list is served by /api/cafes/top?city=<code>.)
+    """
+
+    city_code = request.args.get("city")
+    if city_code and city_registry.get(city_code):
+        city_codes = [city_code]
+    else:
+        city_codes = leaderboard.top_cities(
+            current_app.config['TOP_CITIES_SHOWN'])
+
+    by_city = []
+    for city_code in city_codes:
+        city = city_registry.get(city_code)
+        cafes = leaderboard.top(city_code, n=3)
+        if city and cafes:
+            by_city.append((city, cafes))
+
+    return {"top_cafes": leaderboard.top(), "top_cafes_by_city": by_city}
+
+
+def cache_page(view):
+    """Cache a view's rendered page for anonymous users.
+
+    Pages are cached under the PAGES_VERSION read (in one primary key
+    lookup) before rendering, so a page is never stored under a newer
+    version than the data it shows. Responses get a strong ETag, so
+    clients can revalidate with If-None-Match and get a 304. (There's no
+    Last-Modified: like counts change pages without a new version.)
+
+    Put @use_replica outside this, so the version and the page are read
+    from the same database.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # logged-in pages and pages carrying flash messages are per-user
+        if g.user or session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        version = DataVersion.get(PAGES_VERSION)
+        page = page_cache.get(request.full_path, version)
+        cache_lookups.labels('page', 'miss' if page is None else 'hit').inc()
+
+        if page is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            page = page_cache.set(
+                request.full_path, version, response.get_data(),
+                response.mimetype)
+
+        response = Response(page.body, mimetype=page.mimetype)
+        response.set_etag(page.etag)
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+
+        return response.make_conditional(request)
+
+    return wrapper
+
+
+@bp.route('/cafes')
+@use_replica
+@cache_page
+@query_budget(5)
 def cafe_list():
-    """Return list of all cafes."""
+    """Return one page of cafes, ordered by name (or, with `sort=popular`,
+    most liked first).
 
-    cafes = Cafe.query.order_by('name').all()
+    Takes optional `after` or `before` cursors from the previous page links.
+    """
+
+    sort = request.args.get("sort", "name")
+    if sort not in Cafe.SORTS:
+        abort(400)
+
+    try:
+        after = _cafe_cursor(request.args.get("after"), sort)
+        before = _cafe_cursor(request.args.get("before"), sort)
+    except ValueError:
+        abort(400)
+
+    cafes, next_cursor, prev_cursor = Cafe.get_page(
+        after=after,
+        before=before,
+        per_page=current_app.config['CAFES_PER_PAGE'],
+        sort=sort,
+    )
 
     return render_template(
         'cafe/list.html',
         cafes=cafes,
+        sort=sort,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
+        **top_cafes(),
+    )
+
+
+def _cafe_cursor(cursor, sort="name"):
+    """Decode a (sort key, id) cafe list cursor; None if not given."""
+
+    if not cursor:
+        return None
+
+    key_type = str if sort == "name" else int
+    values = decode_cursor(cursor)
+    if (len(values) != 2
+            or not isinstance(values[0], key_type)
+            or not isinstance(values[1], int)):
+        raise ValueError(f"Invalid cafe cursor: {cursor!r}")
+
+    return values
+
+
+@bp.route('/cafes/search')
+@use_replica
+@query_budget(4)
+def cafe_search():
+    """Show cafes matching search `q`, best match first, paginated by
+    `page`.
+    """
+
+    q, page = _search_args()
+    cafes, has_more = _search_cafes(q, page)
+
+    return render_template(
+        'cafe/search.html',
+        cafes=cafes,
+        q=q,
+        page=page,
+        has_more=has_more,
     )
 
-@app.route('/cafes/<int:cafe_id>')
+
+@bp.route('/api/cafes/search')
+@use_replica
+@query_budget(4)
+def cafe_search_api():
+    """Return JSON {cafes: [...], page, next_page} matching search `q`."""
+
+    q, page = _search_args()
+    cafes, has_more = _search_cafes(q, page)
+
+    return jsonify({
+        "cafes": [cafe.serialize() for cafe in cafes],
+        "page": page,
+        "next_page": page + 1 if has_more else None,
+    })
+
+
+def _search_args():
+    """Return (q, page) from the request's search arguments."""
+
+    q = request.args.get("q", "").strip()
+    page = max(request.args.get("page", 1, type=int), 1)
+    return q, page
+
+
+def _search_cafes(q, page):
+    """Return (cafes, has_more) for search q; nothing for an empty q."""
+
+    if not q:
+        return [], False
+
+    return Cafe.search(q, page=page, per_page=current_app.config['CAFES_PER_PAGE'])
+
+
+@bp.route('/cafes/nearby')
+@use_replica
+def cafes_nearby():
+    """Return JSON {cafes: [...]} near `lat`/`lng`, nearest first.
+
+    Returns cafes within `radius` km (default 2), or with `k` the k nearest
+    within `radius`. Each cafe has its `distance_km`.
+    """
+
+    lat = request.args.get("lat", type=float)
+    lng = request.args.get("lng", type=float)
+    radius = request.args.get("radius", 2.0, type=float)
+    k = request.args.get("k", type=int)
+
+    max_radius = current_app.config['NEARBY_MAX_RADIUS_KM']
+    max_results = current_app.config['NEARBY_MAX_RESULTS']
+
+    if lat is None or lng is None or not (
+            -90 <= lat <= 90 and -180 <= lng <= 180):
+        return jsonify({"error": "Invalid lat/lng"}), 400
+    if not 0 < radius <= max_radius:
+        return jsonify(
+            {"error": f"radius must be between 0 and {max_radius} km"}), 400
+    if k is not None and not 0 < k <= max_results:
+        return jsonify(
+            {"error": f"k must be between 1 and {max_results}"}), 400
+
+    if k is None:
+        found = Cafe.nearby(lat, lng, radius, limit=max_results)
+    else:
+        found = Cafe.nearest(lat, lng, k, max_radius_km=radius)
+
+    return jsonify({"cafes": [
+        {**cafe.serialize(), "distance_km": round(distance, 3)}
+        for cafe, distance in found]})
+
+
+# user, cafe, like, similar cafes; and the city registry when it's cold
+@bp.route('/cafes/<int:cafe_id>')
+@use_replica
+@cache_page
+@query_budget(5)
 def cafe_detail(cafe_id):
-    """Show detail for cafe."""
+    """Show detail for cafe, with its like count, whether the user likes
+    it, and cafes liked by the same users.
+    """
 
     cafe = Cafe.query.get_or_404(cafe_id)
     user = g.user
+    liked = user.is_liking(cafe_id) if user else False
+    similar = SimilarCafe.get_for(
+        cafe_id, current_app.config['SIMILAR_CAFES_SHOWN'])
 
     return render_template(
         'cafe/detail.html',
         cafe=cafe,
-        user=user
+        user=user,
+        like_count=cafe.like_count,
+        liked=liked,
+        similar_cafes=similar,
     )
 
-@app.route('/cafes/add', methods=["GET", "POST"])
+def form_image_url(form):
+    """Return URL of the image uploaded with form, or else its image url."""
+
+    if form.image.data:
+        return thumbnailer.save_upload(form.image.data)
+    return form.image_url.data
+
+
+@bp.route('/images/<name>')
+def image(name):
+    """Serve an uploaded image or a thumbnail.
+
+    Their names are hashes of their content, so they can be cached forever.
+    """
+
+    path = thumbnailer.path(name)
+    if path is None:
+        abort(404)
+
+    response = send_file(path, conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@bp.route('/cafes/add', methods=["GET", "POST"])
 def add_cafe_form():
     """Show and process form for adding a new cafe. """
 
     form = CafeForm()
 
-    # make cities dinamic
-    cities = [(city.code, city.name) for city in City.query.all()]
-    form.city_code.choices = cities
-
     if form.validate_on_submit():
         name = form.name.data
         description = form.description.data
         url = form.url.data
         address = form.address.data
         city_code = form.city_code.data
-        image_url = form.image_url.data
-    
+        image_url = form_image_url(form)
+        latitude = form.latitude.data
+        longitude = form.longitude.data
+
         cafe = Cafe(
             name=name,
             description=description,
             url=url,
             address=address,
             city_code=city_code,
-            image_url=image_url or None
+            image_url=image_url or None,
+            latitude=latitude,
+            longitude=longitude,
         )
 
         db.session.add(cafe)
@@ -210,7 +629,7 @@ def add_cafe_form():
         'cafe/add-form.html', form=form
     )
 
-@app.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
+@bp.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
 def edit_cafe_form(cafe_id):
     """ Show and process form for editting cafe."""
 
@@ -219,8 +638,6 @@ def edit_cafe_form(cafe_id):
         if (user.admin):
             cafe = Cafe.query.get_or_404(cafe_id)
             form = CafeForm(obj=cafe)
-            cities = [(city.code, city.name) for city in City.query.all()]
-            form.city_code.choices = cities
 
             if form.validate_on_submit():
                 cafe.name = form.name.data
@@ -228,7 +645,9 @@ def edit_cafe_form(cafe_id):
                 cafe.url = form.url.data
                 cafe.address = form.address.data
                 cafe.city_code = form.city_code.data
-                cafe.image_url = form.image_url.data
+                cafe.image_url = form_image_url(form)
+                cafe.latitude = form.latitude.data
+                cafe.longitude = form.longitude.data
 
                 db.session.commit()
 
@@ -245,26 +664,196 @@ def edit_cafe_form(cafe_id):
     else:
         return redirect('/login')
 
+def admin_required(view):
+    """Only let admins see view (others must log in, or get a 401)."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if CURR_USER_KEY not in session:
+            return redirect('/login')
+        if not g.user.admin:
+            return Response(
+                'Could not verify your access level for that URL.\n'
+                'You have to login with proper credentials', 401)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@bp.route('/admin/profiles')
+@admin_required
+def admin_profiles():
+    """List saved request profiles."""
+
+    return render_template(
+        'admin/profiles.html',
+        profiles=profile_store.list(),
+        enabled=bool(current_app.config['PROFILE_DIR']),
+    )
+
+
+@bp.route('/admin/profiles/<name>')
+@admin_required
+def admin_profile_download(name):
+    """Download a saved request profile."""
+
+    path = profile_store.path(name)
+    if path is None:
+        abort(404)
+
+    return send_file(path, as_attachment=True, attachment_filename=name)
+
+
+@bp.route('/api/cafes/top')
+def top_cafes_api():
+    """Return JSON {cafes: [...]} of the most liked cafes, overall or in
+    `city` (a city code); at most `limit` (default LEADERBOARD_SIZE).
+    """
+
+    city_code = request.args.get("city") or None
+    if city_code is not None and city_registry.get(city_code) is None:
+        return jsonify({"error": "Unknown city"}), 400
+
+    limit = request.args.get("limit", leaderboard.size, type=int)
+    if not 1 <= limit <= leaderboard.size:
+        return jsonify(
+            {"error": f"limit must be between 1 and {leaderboard.size}"}), 400
+
+    cafes = leaderboard.top(city_code, limit)
+    return jsonify({
+        "city": city_code,
+        "cafes": [cafe._asdict() for cafe in cafes],
+    })
+
+
+@bp.route('/api/cafes/<int:cafe_id>/similar')
+@use_replica
+@query_budget(2)
+def similar_cafes_api(cafe_id):
+    """Return JSON {cafes: [...]} of cafes liked by users who like this
+    one, most similar first; at most `limit` (default SIMILAR_CAFES).
+    """
+
+    most = current_app.config['SIMILAR_CAFES']
+    limit = request.args.get("limit", most, type=int)
+    if not 1 <= limit <= most:
+        return jsonify({"error": f"limit must be between 1 and {most}"}), 400
+
+    if Cafe.query.get(cafe_id) is None:
+        return jsonify({"error": "No such cafe"}), 404
+
+    rows = SimilarCafe.get_for(cafe_id, limit)
+
+    return jsonify({
+        "cafe_id": cafe_id,
+        "cafes": [{
+            "id": row.id,
+            "name": row.name,
+            "city_code": row.city_code,
+            "image_url": row.image_url,
+            "score": row.score,
+        } for row in rows],
+    })
+
+
+@bp.route('/api/cafes')
+@use_replica
+def export_cafes():
+    """Stream all cafes as newline-delimited JSON (or a JSON array with
+    `format=json`).
+
+    Optional filters: `city` (city code) and `updated_since` (ISO 8601;
+    UTC unless it has an offset).
+    """
+
+    city_code = request.args.get("city")
+    fmt = request.args.get("format", "ndjson")
+
+    try:
+        updated_since = request.args.get("updated_since")
+        if updated_since:
+            updated_since = datetime.fromisoformat(updated_since)
+            # updated_at is stored as naive UTC
+            if updated_since.tzinfo is not None:
+                updated_since = (updated_since.astimezone(timezone.utc)
+                                 .replace(tzinfo=None))
+    except ValueError:
+        return jsonify({"error": "Invalid updated_since"}), 400
+
+    if fmt not in ("ndjson", "json"):
+        return jsonify({"error": "Invalid format"}), 400
+
+    cafes = Cafe.iter_export(city_code=city_code, updated_since=updated_since)
+
+    if fmt == "ndjson":
+        def generate():
+            for cafe in cafes:
+                yield json.dumps(cafe) + "\n"
+
+        mimetype = "application/x-ndjson"
+
+    else:
+        def generate():
+            yield "["
+            for i, cafe in enumerate(cafes):
+                yield ("," if i else "") + json.dumps(cafe)
+            yield "]"
+
+        mimetype = "application/json"
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
 #######################################
 # User Data
 
 
-@app.route('/profile')
+@bp.route('/profile')
+@use_replica
+@query_budget(3)
 def user_profile():
     """ If user logged in, show profile page. Otherwise, send to login."""
     if CURR_USER_KEY in session:
-        return render_template('/profile/detail.html')
+        try:
+            after = _like_cursor(request.args.get("after"))
+        except ValueError:
+            abort(400)
+
+        liked_cafes, next_cursor = Like.get_page(
+            g.user.id,
+            after=after,
+            per_page=current_app.config['LIKES_PER_PAGE'],
+        )
+        return render_template(
+            '/profile/detail.html',
+            liked_cafes=liked_cafes,
+            next_cursor=next_cursor,
+        )
     else:
         return redirect('/login')
 
 
-@app.route('/profile/edit', methods=["GET", "POST"])
+def _like_cursor(cursor):
+    """Decode a (liked_at, cafe id) liked cafes cursor; None if not given."""
+
+    if not cursor:
+        return None
+
+    values = decode_cursor(cursor)
+    if (len(values) != 2
+            or not isinstance(values[0], str)
+            or not isinstance(values[1], int)):
+        raise ValueError(f"Invalid like cursor: {cursor!r}")
+
+    return datetime.fromisoformat(values[0]), values[1]
+
+
+@bp.route('/profile/edit', methods=["GET", "POST"])
 def edit_user():
     """If user logged in, show and process form for editing user information.
     Otherwise, send to login page.
     """
     if CURR_USER_KEY in session:
-        user = g.user
+        user = User.query.get_or_404(g.user.id)
         form = ProfileEditForm(obj=user)
 
         if form.validate_on_submit():
@@ -272,9 +861,11 @@ def edit_user():
             user.last_name = form.last_name.data
             user.description = form.description.data
             user.email = form.email.data
-            user.image_url = form.image_url.data or "/static/images/default-pic.png"
+            user.image_url = (
+                form_image_url(form) or "/static/images/default-pic.png")
 
             db.session.commit()
+            user_cache.pop(user.id)
 
             flash("Profile edited.")
             return redirect("/profile")
@@ -286,51 +877,181 @@ def edit_user():
 #######################################
 # Like cafe
 
-@app.route('/api/likes')
+MAX_LIKES_BATCH = 100
+MAX_BULK_LIKES = 1000
+
+
+def _is_cafe_id(value):
+    """Return True if value (from JSON) is an integer id."""
+
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _unknown_cafe_ids(cafe_ids):
+    """Return sorted list of cafe_ids that aren't cafes."""
+
+    if not cafe_ids:
+        return []
+
+    known = {cafe_id for (cafe_id,) in db.session.query(Cafe.id)
+             .filter(Cafe.id.in_(cafe_ids))}
+    return sorted(set(cafe_ids) - known)
+
+
+@bp.route('/api/likes')
+@use_replica
+@query_budget(2)
 def like_cafes():
-    """If user log in, return if user like the cafe or not"""
+    """If user log in, return if user like the cafe or not.
+
+    With `cafe_id=1` returns {"likes": true/false}; with `cafe_ids=1,2,3`
+    returns {"likes": {"1": true, "2": false, ...}} from one query.
+    """
     if CURR_USER_KEY in session:
-        cafe_id = request.args.get("cafe_id")
         user = g.user
-        print(user.id)
-        print(user.likes)
-        for like in user.likes:
-            if like.cafe_id == int(cafe_id or 0):
-                print("get True")
-                return jsonify({"likes": True})
 
-        return jsonify({"likes": False})
+        if "cafe_ids" in request.args:
+            try:
+                cafe_ids = [
+                    int(cafe_id)
+                    for cafe_id in request.args["cafe_ids"].split(",")
+                    if cafe_id.strip()]
+            except ValueError:
+                return jsonify({"error": "Invalid cafe_ids"}), 400
+
+            if len(cafe_ids) > MAX_LIKES_BATCH:
+                return jsonify(
+                    {"error": f"At most {MAX_LIKES_BATCH} cafe_ids"}), 400
+
+            liked = user.liked_cafe_ids(cafe_ids)
+            return jsonify({
+                "likes": {str(cafe_id): cafe_id in liked
+                          for cafe_id in cafe_ids}})
+
+        try:
+            cafe_id = int(request.args.get("cafe_id") or 0)
+        except ValueError:
+            return jsonify({"error": "Invalid cafe_id"}), 400
+
+        return jsonify({"likes": user.is_liking(cafe_id)})
 
     return jsonify({"error": "Not logged in"})
 
-@app.route('/api/like', methods=["POST"])
+@bp.route('/api/users/me/likes')
+@use_replica
+@query_budget(2)
+def my_likes():
+    """If user log in, return a page of the cafes they like, newest first.
+
+    Returns {"likes": [...], "next_cursor": ...}; pass `after=next_cursor`
+    for the next page (next_cursor is null on the last one).
+    """
+    if CURR_USER_KEY in session:
+        try:
+            after = _like_cursor(request.args.get("after"))
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+        rows, next_cursor = Like.get_page(
+            g.user.id,
+            after=after,
+            per_page=current_app.config['LIKES_PER_PAGE'],
+        )
+
+        return jsonify({
+            "likes": [{
+                "id": row.id,
+                "name": row.name,
+                "city_code": row.city_code,
+                "image_url": row.image_url,
+                "liked_at": row.liked_at.isoformat(),
+            } for row in rows],
+            "next_cursor": next_cursor,
+        })
+    return jsonify({"error": "Not logged in"})
+
+@bp.route('/api/like', methods=["POST"])
+@rate_limiter.limit("likes")
 def like():
     """if the user log in, make the user like the cafe"""
     if CURR_USER_KEY in session:
-        cafe_id = int(request.json["cafe_id"])
-        print(type(cafe_id))
-        user_id = g.user.id
-        print(type(user_id))
-        like = Like(
-            cafe_id=cafe_id,
-            user_id=user_id
-        )
-        print(like)
-        db.session.add(like)
-        print("====================================")
-        print(like)
+        cafe_id = (request.get_json(silent=True) or {}).get("cafe_id")
+        if not _is_cafe_id(cafe_id):
+            return jsonify({"error": "Invalid cafe_id"}), 400
+        if _unknown_cafe_ids([cafe_id]):
+            return jsonify({"error": "No such cafe"}), 404
+
+        Like.add_many(g.user.id, [cafe_id])
         db.session.commit()
+        leaderboard.refresh([cafe_id])
+        likes_total.labels('like').inc()
         return jsonify({"liked": cafe_id})
     return jsonify({"error": "Not logged in"})
 
-@app.route('/api/unlike', methods=["POST"])
+@bp.route('/api/unlike', methods=["POST"])
+@rate_limiter.limit("likes")
 def unlike():
     """if the user log in, make the user unlike the cafe"""
     if CURR_USER_KEY in session:
-        cafe_id = int(request.json["cafe_id"])
+        cafe_id = (request.get_json(silent=True) or {}).get("cafe_id")
+        if not _is_cafe_id(cafe_id):
+            return jsonify({"error": "Invalid cafe_id"}), 400
+        if _unknown_cafe_ids([cafe_id]):
+            return jsonify({"error": "No such cafe"}), 404
+
         user_id = g.user.id
         Like.query.filter_by(cafe_id=cafe_id, user_id=user_id).delete()
         db.session.commit()
+        leaderboard.refresh([cafe_id])
+        likes_total.labels('unlike').inc()
 
         return jsonify({"unliked": cafe_id})
     return jsonify({"error": "Not logged in"})
+
+
+@bp.route('/api/likes/bulk', methods=["POST"])
+@rate_limiter.limit("likes")
+def bulk_likes():
+    """if the user log in, like and unlike many cafes in one transaction.
+
+    Takes JSON {"like": [cafe_id, ...], "unlike": [cafe_id, ...]}, lists of
+    integer ids. Liking an already-liked cafe or unliking a not-liked one
+    is a no-op; any id that isn't a cafe fails the whole request (404).
+    """
+    if CURR_USER_KEY in session:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Invalid cafe ids"}), 400
+
+        like_ids = data.get("like", [])
+        unlike_ids = data.get("unlike", [])
+        if not all(isinstance(ids, list) and all(map(_is_cafe_id, ids))
+                   for ids in (like_ids, unlike_ids)):
+            return jsonify({"error": "Invalid cafe ids"}), 400
+        like_ids, unlike_ids = set(like_ids), set(unlike_ids)
+
+        if len(like_ids) + len(unlike_ids) > MAX_BULK_LIKES:
+            return jsonify(
+                {"error": f"At most {MAX_BULK_LIKES} cafe ids"}), 400
+
+        if like_ids & unlike_ids:
+            return jsonify({"error": "Cannot like and unlike a cafe"}), 400
+
+        unknown = _unknown_cafe_ids(like_ids | unlike_ids)
+        if unknown:
+            return jsonify(
+                {"error": "No such cafes", "cafe_ids": unknown}), 404
+
+        user_id = g.user.id
+        Like.add_many(user_id, like_ids)
+        Like.remove_many(user_id, unlike_ids)
+        db.session.commit()
+        leaderboard.refresh(like_ids | unlike_ids)
+        likes_total.labels('like').inc(len(like_ids))
+        likes_total.labels('unlike').inc(len(unlike_ids))
+
+        return jsonify({
+            "liked": sorted(like_ids),
+            "unliked": sorted(unlike_ids),
+        })
+    return jsonify({"error": "Not logged in"})
@@ -0,0 +1,156 @@
+"""Fingerprinted static assets for Flask Cafe.
+
+`flask build-assets` copies each file in static/ to static/dist/ with a
+hash of its content in its name (js/liked.js -> js/liked.1a2b3c4d5e6f.js),
+plus gzip and (if the brotli package is installed) brotli compressed
+copies of text files, and writes static/dist/manifest.json mapping the
+original names to the fingerprinted ones.
+
+In templates, asset_url('js/liked.js') gives the fingerprinted URL (or the
+plain static URL, before a build). Those are served with the best
+precompressed variant the client accepts, and cached as immutable: a
+changed file gets a new name.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import with_appcontext
+
+DIST_DIR = "dist"
+MANIFEST = "manifest.json"
+
+# extensions worth compressing (images etc. already are)
+COMPRESSIBLE = {".css", ".js", ".json", ".map", ".svg", ".txt", ".html"}
+
+# Content-Encoding -> extension of files compressed with it, by preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def fingerprint(filename, data):
+    """Return filename with a hash of data before its extension."""
+
+    root, ext = os.path.splitext(filename)
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    return f"{root}.{digest}{ext}"
+
+
+def load_manifest(static_folder):
+    """Return {name: fingerprinted name} from static_folder's manifest
+    (empty if assets haven't been built).
+    """
+
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(filename):
+    """Return URL of static file (fingerprinted, if assets are built)."""
+
+    manifest = current_app.extensions['assets']
+    built = manifest.get(filename)
+    if built is None:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=f"{DIST_DIR}/{built}")
+
+
+def init_app(app):
+    """Add asset_url() to app's templates and serve built assets."""
+
+    manifest = load_manifest(app.static_folder)
+    app.extensions['assets'] = manifest
+    built = {f"{DIST_DIR}/{name}" for name in manifest.values()}
+
+    app.add_template_global(asset_url)
+
+    def static(filename):
+        """Serve static file; built ones precompressed and immutable."""
+
+        if filename not in built:
+            return app.send_static_file(filename)
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        for encoding, ext in ENCODINGS:
+            if (request.accept_encodings[encoding]
+                    and os.path.isfile(
+                        os.path.join(app.static_folder, filename + ext))):
+                response = send_from_directory(
+                    app.static_folder, filename + ext, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(app.static_folder, filename)
+
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.view_functions['static'] = static
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    """Fingerprint and precompress static files into static/dist/."""
+
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        click.echo("brotli isn't installed; only making .gz files", err=True)
+
+    static_folder = current_app.static_folder
+    dist = os.path.join(static_folder, DIST_DIR)
+    manifest = {}
+
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        if os.path.abspath(dirpath) == os.path.abspath(static_folder):
+            dirnames[:] = [d for d in dirnames if d != DIST_DIR]
+
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, static_folder).replace(os.sep, "/")
+
+            with open(path, "rb") as f:
+                data = f.read()
+
+            built = fingerprint(name, data)
+            manifest[name] = built
+            built_path = os.path.join(dist, built)
+            if os.path.exists(built_path):
+                continue
+
+            os.makedirs(os.path.dirname(built_path), exist_ok=True)
+            shutil.copyfile(path, built_path)
+
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                # mtime=0 keeps the output the same for the same input
+                _write(built_path + ".gz",
+                       gzip.compress(data, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    _write(built_path + ".br", brotli.compress(data))
+
+            click.echo(f"{name} -> {DIST_DIR}/{built}")
+
+    _write(os.path.join(dist, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode("utf8"))
+    click.echo(f"Done: {len(manifest)} assets")
@@ -0,0 +1,140 @@
+"""In-process caches for Flask Cafe."""
+
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with an optional time-to-live.
+
+    Holds at most `maxsize` entries; entries older than `ttl` seconds are
+    treated as missing. A `ttl` of None keeps entries until evicted.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return cached value for key, or default if missing or expired."""
+
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires <= self.timer():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache value under key, evicting the least recently used entry."""
+
+        expires = None if self.ttl is None else self.timer() + self.ttl
+
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove key from cache, returning its value (or default)."""
+
+        with self._lock:
+            entry = self._data.pop(key, None)
+
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        """Remove everything from cache."""
+
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter of strings.
+
+    `in` may give false positives (at about error_rate once `capacity`
+    items are added), but never false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        """Yield bit positions for item (by double hashing)."""
+
+        digest = hashlib.blake2b(item.encode("utf8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item):
+        """Add item to filter."""
+
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+
+CachedPage = namedtuple('CachedPage', ['body', 'mimetype', 'etag'])
+
+
+class PageCache:
+    """Cache of rendered pages, keyed by path and the version of the data
+    they show.
+
+    Look the data version up before rendering, and pass that same version
+    to get() and set(): a page rendered from older data is then only ever
+    stored under the older version, so can't be served once the version
+    has moved on.
+    """
+
+    def __init__(self, maxsize=256, ttl=None):
+        self._pages = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, path, version):
+        """Return CachedPage for path at version, or None."""
+
+        return self._pages.get((version, path))
+
+    def set(self, path, version, body, mimetype):
+        """Cache body for path at version; return the CachedPage (with
+        strong etag).
+        """
+
+        etag = hashlib.sha1(body).hexdigest()
+        page = CachedPage(body, mimetype, etag)
+        self._pages.set((version, path), page)
+        return page
+
+    def clear(self):
+        """Drop all cached pages."""
+
+        self._pages.clear()
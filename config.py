@@ -0,0 +1,143 @@
+"""Configuration profiles for Flask Cafe.
+
+Pick one with create_app(config) in app.py, either by class or by name
+("development", "test", "production"); by default it comes from the
+FLASK_CONFIG environment variable, or is production if that's unset.
+"""
+
+import os
+
+
+class Config:
+    """Settings shared by all profiles."""
+
+    SECRET_KEY = os.environ.get('FLASK_SECRET_KEY')
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'DATABASE_URL', 'postgresql:///flaskcafe')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    # read replicas, used by @use_replica views (see dbrouting.py)
+    SQLALCHEMY_REPLICA_URIS = [
+        uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if uri]
+    DB_READ_YOUR_WRITES_SECONDS = 5
+
+    # connection pool, per database and per worker process
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = True
+
+    # the debug toolbar is only imported and set up when this is on
+    DEBUG_TB_ENABLED = False
+
+    # bcrypt cost, and the pool hashing runs in (see hashing.py)
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    HASHING_WORKERS = int(os.environ.get('HASHING_WORKERS', 2))
+    HASHING_MAX_QUEUE = int(os.environ.get('HASHING_MAX_QUEUE', 8))
+    # build the taken-usernames Bloom filter in a background thread
+    USERNAME_INDEX_BACKGROUND = True
+
+    # number of reverse proxies in front of the app whose X-Forwarded-For
+    # and X-Forwarded-Proto to trust (0: none, use the peer address)
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+    PROXY_FIX_X_PROTO = int(os.environ.get('PROXY_FIX_X_PROTO', 0))
+
+    # per-client limits for @rate_limiter.limit views (see ratelimit.py)
+    RATELIMIT_ENABLED = True
+    RATELIMIT_MAX_KEYS = 100000
+    RATELIMITS = {
+        'login': '10/minute',
+        'likes': '60/minute',
+    }
+
+    # SQL instrumentation (see instrumentation.py)
+    SERVER_TIMING_ENABLED = True
+    SQL_QUERY_BUDGET_STRICT = False
+
+    # Prometheus metrics (see metrics.py): with several worker processes,
+    # set METRICS_DIR to a directory they all share
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_DUMP_INTERVAL = 5
+    # exited processes' counts are dropped once their dump is this old
+    METRICS_STALE_AFTER = 300
+
+    # request profiling (see profiling.py); off unless PROFILE_DIR is set
+    PROFILE_DIR = os.environ.get('PROFILE_DIR')
+    PROFILE_MAX_FILES = 50
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_SLOW_SECONDS = (
+        float(os.environ.get('PROFILE_SLOW_SECONDS', 0)) or None)
+    PROFILE_SAMPLE_INTERVAL = 0.005
+
+    # image thumbnails (see thumbnails.py); kept in instance/thumbnails by
+    # default
+    THUMBNAILS_ENABLED = True
+    THUMBNAIL_DIR = os.environ.get('THUMBNAIL_DIR')
+    THUMBNAIL_WIDTHS = (160, 320, 640, 960)
+    THUMBNAIL_QUALITY = 80
+    THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+    THUMBNAIL_MAX_BYTES = 10 * 1024 * 1024
+    # images waiting to be thumbnailed; more are dropped until next shown
+    THUMBNAIL_MAX_PENDING = 100
+
+    CAFES_PER_PAGE = 24
+    LIKES_PER_PAGE = 24
+    LEADERBOARD_SIZE = 10
+    # extra cafes kept per ranking, to replace ones that drop out
+    LEADERBOARD_HEADROOM = 10
+    LEADERBOARD_MAX_AGE = 60
+    # cities with their own most liked list on the homepage and cafe list
+    TOP_CITIES_SHOWN = 6
+    # similar cafes kept per cafe, and shown on its page
+    SIMILAR_CAFES = 10
+    SIMILAR_CAFES_SHOWN = 4
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 60
+    PAGE_CACHE_SIZE = 256
+    PAGE_CACHE_TTL = 60
+    NEARBY_MAX_RADIUS_KM = 50
+    NEARBY_MAX_RESULTS = 100
+
+
+class DevelopmentConfig(Config):
+    """Local development: SQL echo and the debug toolbar. Only ever used
+    when asked for by name, as its fallback secret key is public.
+    """
+
+    DEBUG = True
+    SECRET_KEY = os.environ.get('FLASK_SECRET_KEY', 'dev-secret-key')
+    SQLALCHEMY_ECHO = True
+    DEBUG_TB_ENABLED = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+
+class TestConfig(Config):
+    """Test suite: separate database, no CSRF."""
+
+    TESTING = True
+    SECRET_KEY = 'test-secret-key'
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'TEST_DATABASE_URL', 'postgresql:///flaskcafe-test')
+    WTF_CSRF_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    HASHING_WORKERS = 0
+    USERNAME_INDEX_BACKGROUND = False
+    RATELIMIT_ENABLED = False
+    SQL_QUERY_BUDGET_STRICT = True
+    THUMBNAILS_ENABLED = False
+    THUMBNAIL_WORKERS = 0
+
+
+class ProductionConfig(Config):
+    """Production: FLASK_SECRET_KEY and DATABASE_URL come from the
+    environment.
+    """
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'test': TestConfig,
+    'production': ProductionConfig,
+}
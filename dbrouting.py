@@ -0,0 +1,116 @@
+"""Read-replica routing and connection pool settings for Flask Cafe.
+
+Views decorated with @use_replica read from one of the replica databases
+in SQLALCHEMY_REPLICA_URIS; everything else (and any write, anywhere) uses
+the primary. After a client writes, its reads stay on the primary for
+DB_READ_YOUR_WRITES_SECONDS, so it always sees its own changes despite
+replication lag. Caches shared by every client load inside
+reading_primary(), so a lagging replica can't leave them behind for all.
+"""
+
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+# flask session key: time until which this client reads from the primary
+PRIMARY_UNTIL_KEY = "db_primary_until"
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads to a replica when the view allows it."""
+
+    def get_bind(self, mapper=None, clause=None):
+        primary = super().get_bind(mapper, clause)
+
+        if not has_request_context():
+            return primary
+
+        if self._flushing or isinstance(clause, UpdateBase):
+            g.db_wrote = True
+            return primary
+
+        if g.get("db_use_replica") and not g.get("db_wrote"):
+            bind_key = g.get("db_replica")
+            if bind_key is None:
+                bind_key = g.db_replica = random.choice(
+                    self.app.config['SQLALCHEMY_REPLICA_BINDS'])
+            return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+
+        return primary
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with tuned pools and read-replica routing."""
+
+    def init_app(self, app):
+        """Set up pool options and replica binds from app's config."""
+
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+            'pool_size': app.config.get('DB_POOL_SIZE', 5),
+            'max_overflow': app.config.get('DB_MAX_OVERFLOW', 10),
+            'pool_recycle': app.config.get('DB_POOL_RECYCLE', -1),
+            'pool_pre_ping': app.config.get('DB_POOL_PRE_PING', False),
+        })
+
+        replica_binds = []
+        binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+        for i, uri in enumerate(app.config.get('SQLALCHEMY_REPLICA_URIS', [])):
+            bind_key = f"replica_{i}"
+            binds[bind_key] = uri
+            replica_binds.append(bind_key)
+        app.config['SQLALCHEMY_REPLICA_BINDS'] = replica_binds
+
+        @app.after_request
+        def stick_to_primary_after_write(response):
+            """Keep client reading from the primary for a while after it
+            writes.
+            """
+
+            if g.get("db_wrote") and replica_binds:
+                session[PRIMARY_UNTIL_KEY] = (
+                    time.time() + app.config['DB_READ_YOUR_WRITES_SECONDS'])
+            return response
+
+        super().init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        # SQLite doesn't use a queue pool, so can't be sized
+        if sa_url.drivername.startswith('sqlite'):
+            engine_opts.pop('pool_size', None)
+            engine_opts.pop('max_overflow', None)
+
+        return super().create_engine(sa_url, engine_opts)
+
+
+def use_replica(view):
+    """Let view read from a replica (unless this client wrote recently)."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_use_replica = (
+            bool(current_app.config['SQLALCHEMY_REPLICA_BINDS'])
+            and session.get(PRIMARY_UNTIL_KEY, 0) < time.time())
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def reading_primary():
+    """Read from the primary within the block, even in a @use_replica view."""
+
+    use_replica = g.pop("db_use_replica", None)
+    try:
+        yield
+    finally:
+        if use_replica is not None:
+            g.db_use_replica = use_replica
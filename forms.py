@@ -1,8 +1,33 @@
 """Forms for Flask Cafe."""
+import os
+
+from flask import current_app
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, SelectField
+from flask_wtf.file import FileField
+from wtforms import StringField, TextAreaField, SelectField, FloatField
 from wtforms.fields.html5 import URLField, EmailField
 from wtforms.validators import InputRequired, Optional, Email, Length
+from wtforms.validators import NumberRange, ValidationError
+
+from models import city_registry
+from thumbnails import image_format
+
+
+def uploaded_image(form, field):
+    """Validate that an uploaded file (if any) is a small enough image."""
+
+    if not field.data:
+        return
+
+    stream = field.data.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+
+    if size > current_app.config['THUMBNAIL_MAX_BYTES']:
+        raise ValidationError("Image is too large.")
+    if image_format(stream) is None:
+        raise ValidationError("Upload a JPEG, PNG, GIF or WebP image.")
 
 
 class CafeForm(FlaskForm):
@@ -14,6 +39,17 @@ class CafeForm(FlaskForm):
     address = StringField("Address:", validators=[InputRequired()])
     city_code = SelectField('City:', coerce=str, validators=[InputRequired()])
     image_url = URLField("Image url:", validators=[Optional()])
+    image = FileField("Or upload an image:", validators=[uploaded_image])
+    latitude = FloatField(
+        "Latitude:", validators=[Optional(), NumberRange(-90, 90)])
+    longitude = FloatField(
+        "Longitude:", validators=[Optional(), NumberRange(-180, 180)])
+
+    def __init__(self, *args, city_choices=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if city_choices is None:
+            city_choices = city_registry.choices()
+        self.city_code.choices = city_choices
 
 class SignupForm(FlaskForm):
     """Form for signing up."""
@@ -39,4 +75,5 @@ class ProfileEditForm(FlaskForm):
     description = TextAreaField("Description:")
     email = EmailField('Email address', validators=[InputRequired(), Email()])
     image_url = URLField("Image url:", validators=[Optional()])
+    image = FileField("Or upload an image:", validators=[uploaded_image])
 
@@ -0,0 +1,112 @@
+"""Geospatial helpers for Flask Cafe: geohash cells and distances.
+
+Cafes store the geohash of their location in an indexed column; a radius
+search looks up the (at most 9) geohash cells covering the search circle
+by prefix, then computes exact distances for just those candidates.
+"""
+
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+MAX_PRECISION = 9
+
+
+def encode(lat, lng, precision=MAX_PRECISION):
+    """Return geohash of (lat, lng) with `precision` characters."""
+
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(chars) < precision:
+        rng, value = (lng_range, lng) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            rng[0] = mid
+        else:
+            bits = bits * 2
+            rng[1] = mid
+
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """Return (height, width) in degrees of a geohash cell."""
+
+    lng_bits = math.ceil(precision * 5 / 2)
+    lat_bits = math.floor(precision * 5 / 2)
+    return 180 / 2 ** lat_bits, 360 / 2 ** lng_bits
+
+
+def covering_cells(lat, lng, radius_km):
+    """Return set of geohash prefixes whose cells cover the circle of
+    radius_km around (lat, lng).
+
+    Picks the finest precision whose cells are at least radius_km across,
+    so the circle can only reach the 8 cells around the center one. Returns
+    None if no precision works (huge radius, or too close to a pole).
+    """
+
+    # cells are narrowest at the latitude of the circle furthest from the
+    # equator
+    extreme_lat = abs(lat) + radius_km / KM_PER_DEGREE
+    if extreme_lat >= 90:
+        return None
+    lng_km_per_degree = KM_PER_DEGREE * math.cos(math.radians(extreme_lat))
+
+    for precision in range(MAX_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        if (height * KM_PER_DEGREE >= radius_km
+                and width * lng_km_per_degree >= radius_km):
+            break
+    else:
+        return None
+
+    cells = set()
+    for dy in (-1, 0, 1):
+        cell_lat = lat + dy * height
+        if not -90 <= cell_lat <= 90:
+            continue
+        for dx in (-1, 0, 1):
+            cell_lng = (lng + dx * width + 180) % 360 - 180
+            cells.add(encode(cell_lat, cell_lng, precision))
+
+    return cells
+
+
+def prefix_upper_bound(prefix):
+    """Return the smallest geohash greater than every geohash starting
+    with prefix (None if there is none), for index range scans.
+    """
+
+    chars = list(prefix)
+    while chars:
+        i = BASE32.index(chars[-1])
+        if i + 1 < len(BASE32):
+            chars[-1] = BASE32[i + 1]
+            return ''.join(chars)
+        chars.pop()
+
+    return None
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Return great-circle (haversine) distance between points in km."""
+
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
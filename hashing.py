@@ -0,0 +1,157 @@
+"""Password hashing for Flask Cafe.
+
+bcrypt is deliberately slow (~250ms of CPU at the default cost), so hashes
+are computed in a small process pool rather than in the request's worker.
+The pool only accepts HASHING_WORKERS + HASHING_MAX_QUEUE jobs at a time;
+past that, HashingBusy is raised (and turned into a fast 503) rather than
+letting a burst of logins queue up behind each other.
+
+Pool processes are started with forkserver (or spawn), not forked from the
+(threaded) web worker. If one dies, the pool is broken: the hash in hand
+fails with HashingBusy and the next one starts a new pool.
+
+With HASHING_WORKERS = 0, hashing runs inline (handy for tests).
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+from flask import current_app
+
+from metrics import registry
+
+hash_duration = registry.histogram(
+    'flaskcafe_password_hash_seconds',
+    'Time to hash or check a password (including any wait for the pool).',
+    ['operation'])
+
+hash_rejected = registry.counter(
+    'flaskcafe_password_hash_rejected_total',
+    'Password hashes refused because the pool was full.')
+
+
+class HashingBusy(Exception):
+    """Raised when too many password hashes are already in progress."""
+
+
+def _hash(password, rounds):
+    """Return bcrypt hash (as str) of password with cost `rounds`."""
+
+    hashed = bcrypt.hashpw(password.encode("utf8"), bcrypt.gensalt(rounds))
+    return hashed.decode("utf8")
+
+
+def _check(hashed, password):
+    """Return True if password matches bcrypt hash."""
+
+    return bcrypt.checkpw(password.encode("utf8"), hashed.encode("utf8"))
+
+
+def _mp_context():
+    """Start method for pool processes: forkserver where available."""
+
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+class PasswordHasher:
+    """Hashes and checks passwords in a bounded process pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._slots = None
+
+    def _config(self, key, default):
+        return current_app.config.get(key, default)
+
+    def _run(self, func, *args):
+        """Run func(*args) in the pool (or inline) and return its result."""
+
+        started = time.perf_counter()
+        result = self._submit(func, *args)
+        hash_duration.labels(func.__name__.lstrip('_')).observe(
+            time.perf_counter() - started)
+        return result
+
+    def _submit(self, func, *args):
+        workers = self._config('HASHING_WORKERS', 0)
+        if not workers:
+            return func(*args)
+
+        with self._lock:
+            # a forked worker process can't use its parent's pool
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=_mp_context())
+                self._pool_pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(
+                    workers + self._config('HASHING_MAX_QUEUE', 0))
+            pool = self._pool
+            slots = self._slots
+
+        if not slots.acquire(blocking=False):
+            hash_rejected.inc()
+            raise HashingBusy()
+
+        try:
+            future = pool.submit(func, *args)
+        except BrokenProcessPool:
+            slots.release()
+            self._discard(pool)
+            raise HashingBusy()
+        except Exception:
+            slots.release()
+            raise
+
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self._discard(pool)
+            raise HashingBusy()
+
+    def _discard(self, pool):
+        """Drop broken pool (if still current); the next hash starts a
+        new one.
+        """
+
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    @property
+    def rounds(self):
+        """Configured bcrypt cost."""
+
+        return self._config('BCRYPT_LOG_ROUNDS', 12)
+
+    def hash(self, password):
+        """Return bcrypt hash of password, at the configured cost."""
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Return True if password matches hashed."""
+
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Return True if hashed wasn't made at the configured cost."""
+
+        # bcrypt hashes look like $2b$<cost>$<salt & hash>
+        try:
+            return int(hashed.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,237 @@
+"""Bulk cafe & city import for Flask Cafe.
+
+Provides the `flask import-cafes` command, which streams a CSV or JSONL
+file of cafes into the database in chunks:
+
+    flask import-cafes cafes.csv --checkpoint cafes-2024-06
+
+Each row has the CafeForm fields (name, description, url, address,
+city_code, image_url, latitude, longitude) plus city_name and city_state
+for the row's city. Cities are upserted; cafes are loaded with COPY on
+PostgreSQL, or a batched executemany on other databases.
+
+Each chunk is committed in its own transaction, which also records the
+number of input rows done under the checkpoint's name (an ImportCheckpoint
+row), so progress and data can't disagree; rerunning with the same
+checkpoint resumes after the last committed chunk.
+"""
+
+import csv
+import io
+import itertools
+import json
+import time
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy.dialects import postgresql
+from werkzeug.datastructures import MultiDict
+
+import geo
+from forms import CafeForm
+from models import db, Cafe, City, DataVersion, PAGES_VERSION
+from models import ImportCheckpoint, invalidate_cities_on_commit
+
+
+CAFE_COLUMNS = (
+    'name',
+    'description',
+    'url',
+    'address',
+    'city_code',
+    'image_url',
+    'latitude',
+    'longitude',
+    'geohash',
+    'updated_at',
+)
+
+DEFAULT_CAFE_IMAGE = Cafe.__table__.c.image_url.default.arg
+
+
+def read_rows(file, fmt):
+    """Yield each input row of file as a dict of strings."""
+
+    if fmt == 'csv':
+        yield from csv.DictReader(file)
+
+    else:
+        for line in file:
+            if line.strip():
+                yield {key: "" if value is None else str(value)
+                       for key, value in json.loads(line).items()}
+
+
+def upsert_cities(rows):
+    """Insert or update the cities named by rows (by city_code)."""
+
+    cities = {}
+    for row in rows:
+        if row.get('city_code') and row.get('city_name'):
+            cities[row['city_code']] = dict(
+                code=row['city_code'],
+                name=row['city_name'],
+                state=row.get('city_state', ''))
+
+    if not cities:
+        return
+
+    table = City.__table__
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        stmt = postgresql.insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.code],
+            set_=dict(name=stmt.excluded.name, state=stmt.excluded.state))
+        db.session.execute(stmt, list(cities.values()))
+
+    else:
+        existing = {code for (code,) in db.session.query(City.code)
+                    .filter(City.code.in_(cities))}
+        new = [city for code, city in cities.items() if code not in existing]
+        changed = [dict(code_=code, name=city['name'], state=city['state'])
+                   for code, city in cities.items() if code in existing]
+
+        if new:
+            db.session.execute(table.insert(), new)
+        if changed:
+            db.session.execute(
+                table.update().where(table.c.code == db.bindparam('code_')),
+                changed)
+
+    invalidate_cities_on_commit(db.session)
+
+
+def city_choices():
+    """Return [(code, name), ...] of cities as this transaction sees them,
+    including ones upserted but not yet committed.
+    """
+
+    return db.session.query(City.code, City.name).order_by(City.name).all()
+
+
+def validate_row(row, choices):
+    """Validate row as CafeForm would, against city choices; return
+    (cafe dict, None) if valid, else (None, errors).
+    """
+
+    formdata = MultiDict(
+        (key, value) for key, value in row.items() if value not in (None, ""))
+    form = CafeForm(
+        formdata=formdata, city_choices=choices, meta={'csrf': False})
+
+    if not form.validate():
+        return None, form.errors
+
+    latitude = form.latitude.data
+    longitude = form.longitude.data
+    located = latitude is not None and longitude is not None
+
+    return dict(
+        name=form.name.data,
+        description=form.description.data,
+        url=form.url.data,
+        address=form.address.data,
+        city_code=form.city_code.data,
+        image_url=form.image_url.data or DEFAULT_CAFE_IMAGE,
+        latitude=latitude,
+        longitude=longitude,
+        geohash=geo.encode(latitude, longitude) if located else None,
+        updated_at=datetime.utcnow(),
+    ), None
+
+
+def load_cafes(cafes):
+    """Bulk insert list of cafe dicts (COPY on PostgreSQL)."""
+
+    if not cafes:
+        return
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for cafe in cafes:
+            writer.writerow([
+                r'\N' if cafe[column] is None else cafe[column]
+                for column in CAFE_COLUMNS])
+        buf.seek(0)
+
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            f"COPY cafes ({', '.join(CAFE_COLUMNS)}) FROM STDIN "
+            r"WITH (FORMAT csv, NULL '\N')",
+            buf)
+
+    else:
+        db.session.execute(Cafe.__table__.insert(), cafes)
+
+
+def import_chunk(rows, first_line, checkpoint=None):
+    """Import a chunk of rows in one transaction (recording progress under
+    checkpoint, if given); return count imported.
+
+    Invalid rows are reported and skipped.
+    """
+
+    upsert_cities(rows)
+    choices = city_choices()
+
+    cafes = []
+    for line, row in enumerate(rows, start=first_line):
+        cafe, errors = validate_row(row, choices)
+        if errors:
+            click.echo(f"Row {line}: skipped, {errors}", err=True)
+        else:
+            cafes.append(cafe)
+
+    load_cafes(cafes)
+    # bulk inserts skip the session hooks that expire cached pages
+    DataVersion.bump(PAGES_VERSION)
+    if checkpoint:
+        ImportCheckpoint.set(checkpoint, first_line - 1 + len(rows))
+    db.session.commit()
+
+    return len(cafes)
+
+
+@click.command('import-cafes')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help="Input format (default: from file extension).")
+@click.option('--chunk-size', default=5000, show_default=True,
+              help="Rows per transaction.")
+@click.option('--checkpoint',
+              help="Name to record progress under, to resume an import.")
+@with_appcontext
+def import_cafes_command(path, fmt, chunk_size, checkpoint):
+    """Bulk import cafes (and their cities) from a CSV or JSONL file."""
+
+    if fmt is None:
+        fmt = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+    rows_done = ImportCheckpoint.get(checkpoint) if checkpoint else 0
+    if rows_done:
+        click.echo(f"Resuming after row {rows_done}")
+
+    imported = 0
+    started = time.monotonic()
+
+    with open(path, newline='', encoding='utf8') as file:
+        rows = itertools.islice(read_rows(file, fmt), rows_done, None)
+
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            imported += import_chunk(
+                chunk, first_line=rows_done + 1, checkpoint=checkpoint)
+            rows_done += len(chunk)
+
+            elapsed = time.monotonic() - started
+            click.echo(
+                f"{rows_done} rows read, {imported} cafes imported "
+                f"({imported / elapsed:.0f} rows/s)")
+
+    click.echo(f"Done: {imported} cafes imported")
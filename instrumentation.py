@@ -0,0 +1,144 @@
+"""Per-request SQL query counting and timing for Flask Cafe.
+
+Every statement run on any engine during a request is counted and timed.
+Each response gets a Server-Timing header (`db` time with the query
+count, and total `app` time), and each endpoint's query counts and DB
+times are recorded in histograms (see endpoint_stats() and /metrics).
+
+Views can declare a query budget with @query_budget(n). Going over it
+logs a warning or, with SQL_QUERY_BUDGET_STRICT on (as in tests), raises
+QueryBudgetExceeded.
+"""
+
+import time
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import registry, endpoint_name
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+DB_TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised (in strict mode) when a view runs more queries than its
+    declared budget.
+    """
+
+
+sql_queries = registry.histogram(
+    'flaskcafe_sql_queries_per_request',
+    'SQL statements run per request.',
+    ['endpoint'],
+    buckets=QUERY_COUNT_BUCKETS)
+
+sql_duration = registry.histogram(
+    'flaskcafe_sql_duration_seconds_per_request',
+    'Time spent running SQL statements per request.',
+    ['endpoint'],
+    buckets=DB_TIME_BUCKETS)
+
+
+def endpoint_stats():
+    """Return {endpoint: {"queries": histogram, "db_seconds": histogram}}
+    snapshots.
+    """
+
+    durations = sql_duration.children()
+    return {
+        endpoint: {
+            "queries": queries.snapshot(),
+            "db_seconds": durations[(endpoint,)].snapshot(),
+        }
+        for (endpoint,), queries in sql_queries.children().items()
+        if (endpoint,) in durations
+    }
+
+
+def query_budget(max_queries):
+    """Declare the most queries the decorated view should run."""
+
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+
+    return decorator
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    _query_done(conn)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # a failed query never reaches after_cursor_execute, but still counts
+    if (context.connection is not None
+            and context.execution_context is not None):
+        _query_done(context.connection)
+
+
+def _query_done(conn):
+    """Count and time the query conn just ran (or failed)."""
+
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+
+    if has_app_context() and 'request_started' in g:
+        g.sql_queries += 1
+        g.sql_seconds += elapsed
+
+
+def init_app(app):
+    """Count and time SQL queries in app's requests.
+
+    Call before registering views' blueprints, so counting starts before
+    any of their before-request hooks run.
+    """
+
+    @app.before_request
+    def start_query_count():
+        g.request_started = time.perf_counter()
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+
+    @app.after_request
+    def record_query_count(response):
+        if 'request_started' not in g:
+            return response
+
+        total = time.perf_counter() - g.request_started
+        queries, db_time = g.sql_queries, g.sql_seconds
+
+        if app.config['SERVER_TIMING_ENABLED']:
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={db_time * 1000:.1f};desc="{queries} queries", '
+                f'app;dur={total * 1000:.1f}')
+
+        if request.endpoint:
+            endpoint = endpoint_name()
+            sql_queries.labels(endpoint).observe(queries)
+            sql_duration.labels(endpoint).observe(db_time)
+
+            view = current_app.view_functions.get(request.endpoint)
+            budget = getattr(view, 'query_budget', None)
+            if budget is not None and queries > budget:
+                message = (f"{request.endpoint} ran {queries} queries, "
+                           f"over its budget of {budget}")
+                if app.config['SQL_QUERY_BUDGET_STRICT']:
+                    raise QueryBudgetExceeded(message)
+                app.logger.warning(message)
+
+        return response
@@ -0,0 +1,249 @@
+"""Most liked cafes, overall and per city, for Flask Cafe.
+
+The leaderboard keeps only the top `size + headroom` cafes of each ranking
+(overall and per city) in memory, in short sorted lists, so reading the
+top N costs O(N) and memory doesn't grow with the number of cafes. It's
+loaded with one query (over the like counts the likes triggers keep on
+cafes), then:
+
+- the like views call refresh(cafe_ids) after changing likes, re-reading
+  just those cafes' counts. A cafe that drops out of a full list can't be
+  replaced without knowing the cafes below it; the headroom absorbs that
+  until a list holds fewer than `size` known cafes, which marks it stale;
+- it's reloaded when stale: after a cafe is written in this process (a
+  rename or delete), or once `max_age` seconds have passed, to pick up
+  likes made in other processes.
+
+Only one request at a time reloads; the others keep serving the lists
+they have meanwhile.
+"""
+
+import bisect
+import heapq
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy import event, func
+from werkzeug.local import LocalProxy
+
+from dbrouting import reading_primary
+from models import db, Cafe
+
+TopCafe = namedtuple("TopCafe", "id name city_code like_count")
+
+
+class _Ranking:
+    """The best `capacity` cafes of one ranking, best first.
+
+    Holds the exact top len(entries) cafes, as sorted
+    [(-like_count, cafe id, TopCafe)]. `complete` while that's every
+    liked cafe in the ranking, so any newly liked cafe belongs in it.
+    """
+
+    def __init__(self, capacity, cafes=(), complete=True):
+        self.capacity = capacity
+        self.entries = sorted((-cafe.like_count, cafe.id, cafe)
+                              for cafe in cafes)[:capacity]
+        self.complete = complete
+
+    def discard(self, cafe_id):
+        for i, (_, entry_id, _) in enumerate(self.entries):
+            if entry_id == cafe_id:
+                del self.entries[i]
+                return
+
+    def update(self, cafe):
+        """Re-rank cafe with its new like count."""
+
+        self.discard(cafe.id)
+        if cafe.like_count <= 0:
+            return
+
+        # below the last entry, unknown cafes may rank ahead of it
+        entry = (-cafe.like_count, cafe.id, cafe)
+        if self.complete or (self.entries and entry < self.entries[-1]):
+            bisect.insort(self.entries, entry)
+            if len(self.entries) > self.capacity:
+                del self.entries[self.capacity:]
+                self.complete = False
+
+    def top(self, n):
+        return [cafe for _, _, cafe in self.entries[:n]]
+
+
+class Leaderboard:
+    """In-process ranking of cafes by like count (one per app)."""
+
+    def __init__(self, size=10, headroom=10, max_age=60,
+                 timer=time.monotonic):
+        self.size = size
+        self.capacity = size + headroom
+        self.max_age = max_age
+        self.timer = timer
+        # {city code (None for overall): _Ranking}; None until first loaded
+        self._rankings = None
+        # None when stale
+        self._loaded_at = None
+        # cafes refreshed while a reload was querying
+        self._refreshed = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def _fresh(self):
+        loaded_at = self._loaded_at
+        return loaded_at is not None and (
+            self.max_age is None or self.timer() - loaded_at < self.max_age)
+
+    def _ensure_loaded(self):
+        """Reload the leaderboard if it's stale, unless another request
+        already is (then wait only if nothing is loaded yet).
+        """
+
+        if self._fresh():
+            return
+
+        if not self._reload_lock.acquire(blocking=self._rankings is None):
+            return
+
+        try:
+            if not self._fresh():
+                self._reload()
+        finally:
+            self._reload_lock.release()
+
+    def _reload(self):
+        """Load the top `capacity` cafes per city, which include the top
+        `capacity` overall.
+        """
+
+        with self._lock:
+            generation = self._generation
+            self._refreshed = set()
+
+        rank = func.row_number().over(
+            partition_by=Cafe.city_code,
+            order_by=(Cafe.like_count.desc(), Cafe.id)).label("rank")
+        ranked = (db.session
+                  .query(Cafe.id, Cafe.name, Cafe.city_code,
+                         Cafe.like_count, rank)
+                  .filter(Cafe.like_count > 0)
+                  .subquery())
+        with reading_primary():
+            rows = (db.session
+                    .query(ranked.c.id, ranked.c.name, ranked.c.city_code,
+                           ranked.c.like_count)
+                    .filter(ranked.c.rank <= self.capacity)
+                    .all())
+
+        by_city = {}
+        for row in rows:
+            by_city.setdefault(row.city_code, []).append(TopCafe(*row))
+
+        rankings = {
+            city_code: _Ranking(self.capacity, cafes,
+                                complete=len(cafes) < self.capacity)
+            for city_code, cafes in by_city.items()}
+        rankings[None] = _Ranking(
+            self.capacity,
+            (TopCafe(*row) for row in rows),
+            complete=(len(rows) < self.capacity
+                      and all(r.complete for r in rankings.values())))
+
+        with self._lock:
+            self._rankings = rankings
+            refreshed, self._refreshed = self._refreshed, None
+            if generation == self._generation:
+                self._loaded_at = self.timer()
+
+        # the query may have missed likes refreshed since it started
+        self.refresh(refreshed)
+
+    def top(self, city_code=None, n=None):
+        """Return the n (default: size) most liked cafes, most liked (then
+        lowest id) first; in city_code, or overall if None.
+        """
+
+        self._ensure_loaded()
+
+        with self._lock:
+            ranking = self._rankings.get(city_code)
+            return ranking.top(n or self.size) if ranking else []
+
+    def top_cities(self, n):
+        """Return the codes of the n cities whose most liked cafe has the
+        most likes (then lowest city code first).
+        """
+
+        self._ensure_loaded()
+
+        with self._lock:
+            best = [(ranking.entries[0][0], city_code)
+                    for city_code, ranking in self._rankings.items()
+                    if city_code is not None and ranking.entries]
+        return [city_code for _, city_code in heapq.nsmallest(n, best)]
+
+    def refresh(self, cafe_ids):
+        """Re-read the like counts of cafe_ids (after they were liked or
+        unliked) and re-rank them.
+        """
+
+        if self._rankings is None or not cafe_ids:
+            return
+
+        with reading_primary():
+            rows = (db.session
+                    .query(Cafe.id, Cafe.name, Cafe.city_code,
+                           Cafe.like_count)
+                    .filter(Cafe.id.in_(cafe_ids))
+                    .all())
+
+        with self._lock:
+            if self._refreshed is not None:
+                self._refreshed.update(cafe_ids)
+
+            found = {row.id for row in rows}
+            for cafe_id in set(cafe_ids) - found:
+                for ranking in self._rankings.values():
+                    ranking.discard(cafe_id)
+
+            for row in rows:
+                cafe = TopCafe(*row)
+                self._rankings[None].update(cafe)
+                self._rankings.setdefault(
+                    cafe.city_code, _Ranking(self.capacity)).update(cafe)
+
+            if any(not ranking.complete and len(ranking.entries) < self.size
+                   for ranking in self._rankings.values()):
+                self._loaded_at = None
+
+    def invalidate(self):
+        """Mark the leaderboard stale; it's reloaded on next use."""
+
+        with self._lock:
+            self._generation += 1
+            self._loaded_at = None
+
+
+# the current app's Leaderboard
+leaderboard = LocalProxy(lambda: current_app.extensions['leaderboard'])
+
+
+@event.listens_for(db.session, 'after_flush')
+def _invalidate_leaderboard_after_flush(session, flush_context):
+    """Reload leaderboard if any cafe was renamed, moved or deleted."""
+
+    written = session.dirty | session.deleted
+    if any(isinstance(obj, Cafe) for obj in written):
+        leaderboard.invalidate()
+
+
+@event.listens_for(db.session, 'after_bulk_update')
+@event.listens_for(db.session, 'after_bulk_delete')
+def _invalidate_leaderboard_after_bulk(context):
+    """Reload leaderboard after a bulk update/delete of cafes."""
+
+    if context.mapper.class_ is Cafe:
+        leaderboard.invalidate()
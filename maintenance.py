@@ -0,0 +1,116 @@
+"""Database maintenance commands for Flask Cafe.
+
+    flask upgrade-db
+
+brings a database created by an older version up to date: it creates
+missing tables, columns and indexes, drops indexes that were replaced,
+adds the full-text search index (and indexes existing cafes in it),
+(re)installs the like count triggers and recounts likes.
+
+    flask reconcile-like-counts
+
+recounts every cafe's likes (Cafe.like_count) from the likes table, for
+after bulk loads or on databases without the like count triggers.
+"""
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from models import db, Cafe, LIKE_COUNT_TRIGGERS, SEARCH_DDL, SEARCH_REBUILD
+
+# indexes replaced by others, dropped by upgrade-db: {name: table}
+OBSOLETE_INDEXES = {
+    'ix_cafes_like_count_id': 'cafes',
+}
+
+
+def add_column(connection, column):
+    """Add column to its (existing) table.
+
+    A NOT NULL column with only a Python-side default is added nullable,
+    filled with that default, then made NOT NULL where the database can.
+    """
+
+    table = column.table
+    fill = (not column.nullable and column.server_default is None
+            and column.default is not None)
+    if fill:
+        column.nullable = True
+    try:
+        ddl = CreateColumn(column).compile(dialect=connection.dialect)
+    finally:
+        if fill:
+            column.nullable = False
+    connection.execute(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+    if fill:
+        default = column.default.arg
+        value = default(None) if callable(default) else default
+        connection.execute(table.update().values({column.name: value}))
+        if connection.dialect.name == 'postgresql':
+            connection.execute(
+                f"ALTER TABLE {table.name} "
+                f"ALTER COLUMN {column.name} SET NOT NULL")
+
+
+def upgrade_db(connection):
+    """Bring the database schema up to date; return list of changes."""
+
+    changes = []
+
+    existing_tables = set(inspect(connection).get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            table.create(connection)
+            changes.append(f"created table {table.name}")
+            continue
+
+        inspector = inspect(connection)
+        columns = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                add_column(connection, column)
+                changes.append(f"added column {table.name}.{column.name}")
+
+        indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+        for name, table_name in OBSOLETE_INDEXES.items():
+            if table_name == table.name and name in indexes:
+                connection.execute(f"DROP INDEX {name}")
+                changes.append(f"dropped index {name}")
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+                changes.append(f"created index {index.name}")
+
+    dialect = connection.dialect.name
+    for stmt in SEARCH_DDL.get(dialect, []) + SEARCH_REBUILD.get(dialect, []):
+        connection.execute(stmt)
+    for stmt in LIKE_COUNT_TRIGGERS.get(dialect, []):
+        connection.execute(stmt)
+
+    return changes
+
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db_command():
+    """Update an existing database's tables, indexes and triggers."""
+
+    for change in upgrade_db(db.session.connection()):
+        click.echo(change)
+
+    fixed = Cafe.reconcile_like_counts()
+    db.session.commit()
+    click.echo(f"Done: {fixed} cafe like counts fixed")
+
+
+@click.command('reconcile-like-counts')
+@with_appcontext
+def reconcile_like_counts_command():
+    """Recount every cafe's likes from the likes table."""
+
+    fixed = Cafe.reconcile_like_counts()
+    db.session.commit()
+    click.echo(f"Done: {fixed} cafe like counts fixed")
@@ -0,0 +1,490 @@
+"""In-process metrics, served in Prometheus text format at /metrics.
+
+Metrics are counters, histograms and gauges, optionally with labels:
+
+    likes = registry.counter(
+        'flaskcafe_likes_total', 'Cafe likes and unlikes.', ['action'])
+    likes.labels('like').inc()
+
+Updates only take a per-metric lock, so are cheap and thread-safe.
+
+With several worker processes, set METRICS_DIR to a directory they all
+share: each process periodically writes its metrics there (to a file named
+by its pid and start time, so a reused pid doesn't overwrite an exited
+process's counts), and /metrics adds up the values from every process.
+Gauges from processes that have exited are left out. Once an exited
+process's file is METRICS_STALE_AFTER seconds old, its counters and
+histograms are folded into one file of exited processes' totals (so the
+sums never go down, which Prometheus would read as a reset) and the file
+is deleted.
+"""
+
+import bisect
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import Response, current_app, g, has_app_context, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# totals of exited processes' counters and histograms, in METRICS_DIR
+EXITED_FILE = "exited-metrics.json"
+LOCK_FILE = "metrics.lock"
+
+LATENCY_BUCKETS = (
+    .005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 7.5, 10)
+
+
+class Histogram:
+    """Thread-safe histogram of observations over fixed bucket bounds."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record value."""
+
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """Return dict of bucket counts (keyed by upper bound, last one
+        "+Inf"), sum and count.
+        """
+
+        with self._lock:
+            bounds = [*self.buckets, "+Inf"]
+            return {
+                "buckets": dict(zip(bounds, self.counts)),
+                "sum": self.sum,
+                "count": self.count,
+            }
+
+    def samples(self):
+        """Yield (suffix, extra labels, value) Prometheus samples."""
+
+        snapshot = self.snapshot()
+        cumulative = 0
+        for bound, count in snapshot["buckets"].items():
+            cumulative += count
+            le = bound if bound == "+Inf" else repr(float(bound))
+            yield "_bucket", {"le": le}, cumulative
+        yield "_sum", {}, snapshot["sum"]
+        yield "_count", {}, snapshot["count"]
+
+
+class Counter:
+    """Thread-safe, monotonically increasing count."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Add amount to count."""
+
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield "", {}, self.value
+
+
+class Metric:
+    """A named metric, with one child Counter/Histogram per set of label
+    values.
+    """
+
+    def __init__(self, name, help, type, labelnames=(), make_child=None):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self._make_child = make_child
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Return child for these label values (created if needed)."""
+
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._make_child())
+        return child
+
+    def children(self):
+        """Return {label values: child} for all children."""
+
+        return dict(self._children)
+
+    def inc(self, amount=1):
+        """Increment an unlabelled counter."""
+
+        self.labels().inc(amount)
+
+    def observe(self, value):
+        """Record value in an unlabelled histogram."""
+
+        self.labels().observe(value)
+
+    def samples(self):
+        """Yield (name, labels dict, value) for all children."""
+
+        for values, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, values))
+            for suffix, extra, value in child.samples():
+                yield self.name + suffix, {**labels, **extra}, value
+
+
+class Gauge:
+    """A metric whose values are read by calling `func` at collection time.
+
+    func returns {label values tuple: value}.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames, func):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.func = func
+
+    def samples(self):
+        for values, value in self.func().items():
+            yield self.name, dict(zip(self.labelnames, values)), value
+
+
+class Registry:
+    """Collection of metrics, able to render them for Prometheus."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._last_dump = 0
+        # (pid, start time) of the process using the registry
+        self._process = None
+
+    def _add(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        """Return counter metric (new, or already registered as name)."""
+
+        return self._add(Metric(name, help, 'counter', labelnames, Counter))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        """Return histogram metric (new, or already registered as name)."""
+
+        return self._add(Metric(
+            name, help, 'histogram', labelnames, lambda: Histogram(buckets)))
+
+    def gauge(self, name, help, labelnames, func):
+        """Register gauge read by calling func (see Gauge), replacing any
+        already registered as name.
+        """
+
+        gauge = self._metrics[name] = Gauge(name, help, labelnames, func)
+        return gauge
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def _process_id(self):
+        """Return (pid, start time) of this process."""
+
+        # a forked worker is a new process, with its own file
+        if self._process is None or self._process[0] != os.getpid():
+            self._process = (os.getpid(), int(time.time() * 1000))
+        return self._process
+
+    def collect(self):
+        """Return this process's metrics as a JSON-ready dict."""
+
+        pid, started = self._process_id()
+        return {
+            "pid": pid,
+            "started": started,
+            "metrics": [{
+                "name": metric.name,
+                "help": metric.help,
+                "type": metric.type,
+                "samples": [[name, labels, value]
+                            for name, labels, value in metric.samples()],
+            } for metric in list(self._metrics.values())],
+        }
+
+    def dump(self, directory):
+        """Write this process's metrics to its file in directory."""
+
+        pid, started = self._process_id()
+        _write_json(
+            os.path.join(directory, f"metrics-{pid}-{started}.json"),
+            self.collect())
+        self._last_dump = time.monotonic()
+
+    def maybe_dump(self, directory, interval):
+        """Dump, if it's been more than interval seconds since the last."""
+
+        if time.monotonic() - self._last_dump > interval:
+            self.dump(directory)
+
+    def _read_dumps(self, directory, stale_after):
+        """Return [(collection, alive)] for the dumps in directory, first
+        folding those of exited processes older than stale_after seconds
+        into the exited processes' totals.
+        """
+
+        # one process at a time, so no dump is ever counted twice
+        with _locked(os.path.join(directory, LOCK_FILE)):
+            dumps = []
+            for path in glob.glob(os.path.join(directory, "metrics-*.json")):
+                try:
+                    with open(path) as f:
+                        collection = json.load(f)
+                    age = time.time() - os.path.getmtime(path)
+                except (OSError, ValueError):
+                    continue
+                dumps.append((path, collection, age))
+
+            exited_path = os.path.join(directory, EXITED_FILE)
+            try:
+                with open(exited_path) as f:
+                    exited = json.load(f)
+            except (OSError, ValueError):
+                exited = {"metrics": []}
+
+            # the newest dump of each pid; older ones are from exited
+            # processes
+            latest = {}
+            for _, collection, _ in dumps:
+                pid, started = collection["pid"], collection.get("started", 0)
+                latest[pid] = max(latest.get(pid, started), started)
+
+            collections = []
+            folded = []
+            for path, collection, age in dumps:
+                pid, started = collection["pid"], collection.get("started", 0)
+                alive = started == latest[pid] and _is_alive(pid)
+                if (not alive and stale_after is not None
+                        and age > stale_after):
+                    _fold(exited, collection)
+                    folded.append(path)
+                else:
+                    collections.append((collection, alive))
+
+            if folded:
+                _write_json(exited_path, exited)
+                for path in folded:
+                    os.remove(path)
+
+        collections.append((exited, False))
+        return collections
+
+    def render(self, directory=None, stale_after=None):
+        """Return all metrics in Prometheus text format, summed over every
+        process that has dumped to directory (or just this one). Dumps of
+        exited processes are folded into one once stale_after seconds old.
+        """
+
+        if directory is None:
+            collections = [(self.collect(), True)]
+        else:
+            self.dump(directory)
+            collections = self._read_dumps(directory, stale_after)
+
+        families = {}
+        for collection, alive in collections:
+            for metric in collection["metrics"]:
+                if metric["type"] == "gauge" and not alive:
+                    continue
+                family = families.setdefault(
+                    metric["name"], (metric["help"], metric["type"], {}))
+                totals = family[2]
+                for name, labels, value in metric["samples"]:
+                    key = (name, tuple(sorted(labels.items())))
+                    totals[key] = totals.get(key, 0) + value
+
+        lines = []
+        for metric_name, (help, type, totals) in sorted(families.items()):
+            lines.append(f"# HELP {metric_name} {help}")
+            lines.append(f"# TYPE {metric_name} {type}")
+            for (name, labels), value in totals.items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _write_json(path, data):
+    """Atomically write data to path as JSON."""
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """Hold an exclusive lock on file path (shared between processes)."""
+
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _fold(totals, collection):
+    """Add collection's counter and histogram samples into totals (a
+    collection of summed samples); its gauges are dropped.
+    """
+
+    metrics = {metric["name"]: metric for metric in totals["metrics"]}
+    for metric in collection["metrics"]:
+        if metric["type"] == "gauge":
+            continue
+
+        total = metrics.get(metric["name"])
+        if total is None:
+            total = metrics[metric["name"]] = dict(metric, samples=[])
+            totals["metrics"].append(total)
+
+        samples = {}
+        for sample in total["samples"]:
+            name, labels, _ = sample
+            samples[(name, tuple(sorted(labels.items())))] = sample
+        for name, labels, value in metric["samples"]:
+            key = (name, tuple(sorted(labels.items())))
+            if key in samples:
+                samples[key][2] += value
+            else:
+                samples[key] = [name, labels, value]
+                total["samples"].append(samples[key])
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    def escape(value):
+        return (str(value).replace("\\", "\\\\")
+                .replace("\n", "\\n").replace('"', '\\"'))
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+def _is_alive(pid):
+    """Return True if process pid is running."""
+
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = Registry()
+
+requests_total = registry.counter(
+    'flaskcafe_requests_total',
+    'HTTP requests handled.',
+    ['endpoint', 'method', 'status'])
+
+request_duration = registry.histogram(
+    'flaskcafe_request_duration_seconds',
+    'Time to handle HTTP requests.',
+    ['endpoint'])
+
+
+def endpoint_name():
+    """Return short name of the current request's endpoint (its view
+    function's name), or "none" if no route matched.
+    """
+
+    if not request.endpoint:
+        return "none"
+    return request.endpoint.rsplit('.', 1)[-1]
+
+
+def init_app(app, db):
+    """Record request metrics for app, and serve them at /metrics."""
+
+    def pool_stats(stat):
+        # read from whichever app is serving /metrics, so apps made later
+        # don't take over the gauges
+        def read():
+            if not has_app_context():
+                return {}
+
+            app = current_app._get_current_object()
+            engines = {"primary": db.get_engine(app)}
+            for bind_key in app.config['SQLALCHEMY_REPLICA_BINDS']:
+                engines[bind_key] = db.get_engine(app, bind=bind_key)
+
+            values = {}
+            for database, engine in engines.items():
+                # not every pool (e.g. SQLite's) tracks these
+                method = getattr(engine.pool, stat, None)
+                if method is not None:
+                    values[(database,)] = method()
+            return values
+
+        return read
+
+    registry.gauge(
+        'flaskcafe_db_pool_checked_out',
+        'Database connections currently checked out of the pool.',
+        ['database'], pool_stats('checkedout'))
+    registry.gauge(
+        'flaskcafe_db_pool_overflow',
+        'Database connections open beyond the pool size.',
+        ['database'], pool_stats('overflow'))
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.get('metrics_started')
+        if started is not None:
+            endpoint = endpoint_name()
+            requests_total.labels(
+                endpoint, request.method, response.status_code).inc()
+            request_duration.labels(endpoint).observe(
+                time.perf_counter() - started)
+
+        directory = app.config['METRICS_DIR']
+        if directory:
+            registry.maybe_dump(directory, app.config['METRICS_DUMP_INTERVAL'])
+
+        return response
+
+    def metrics_view():
+        """Serve metrics in Prometheus text format."""
+
+        body = registry.render(
+            current_app.config['METRICS_DIR'],
+            current_app.config['METRICS_STALE_AFTER'])
+        return Response(body, content_type=CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -1,12 +1,25 @@
 """Data models for Flask Cafe"""
 
+import base64
+import binascii
+import json
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask import current_app
+from sqlalchemy import DDL, event, inspect
+from sqlalchemy.dialects import postgresql
+from werkzeug.local import LocalProxy
 
+import geo
+from cache import BloomFilter
+from dbrouting import RoutingSQLAlchemy, reading_primary
+from hashing import password_hasher
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+
+db = RoutingSQLAlchemy()
 
 
 class City(db.Model):
@@ -30,6 +43,85 @@ class City(db.Model):
     )
 
 
+CityInfo = namedtuple('CityInfo', ['code', 'name', 'state'])
+
+
+class CityRegistry:
+    """Read-mostly snapshot of all cities keyed by code (one per app).
+
+    Loaded on first use and reloaded after a transaction writing a City
+    commits in this process (see the session hooks below), or once
+    `max_age` seconds have passed, to pick up writes made by other
+    processes.
+    """
+
+    def __init__(self, max_age=300, timer=time.monotonic):
+        self.max_age = max_age
+        self.timer = timer
+        self._cities = None
+        self._loaded_at = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _fresh(self, cities):
+        """Return True if cities is a loaded snapshot still in date."""
+
+        return cities is not None and (
+            self.max_age is None
+            or self.timer() - self._loaded_at < self.max_age)
+
+    def _snapshot(self):
+        """Return the {code: CityInfo} dict, (re)loading it if stale."""
+
+        cities = self._cities
+        if self._fresh(cities):
+            return cities
+
+        with self._lock:
+            cities = self._cities
+            if self._fresh(cities):
+                return cities
+
+            generation = self._generation
+            with reading_primary():
+                rows = (db.session.query(City.code, City.name, City.state)
+                        .order_by(City.name)
+                        .all())
+            cities = {row.code: CityInfo(*row) for row in rows}
+
+            # invalidated while loading: these rows may predate the write
+            if generation == self._generation:
+                self._cities = cities
+                self._loaded_at = self.timer()
+
+            return cities
+
+    def get(self, code):
+        """Return CityInfo for code, or None if no such city."""
+
+        return self._snapshot().get(code)
+
+    def all(self):
+        """Return list of all cities, ordered by name."""
+
+        return list(self._snapshot().values())
+
+    def choices(self):
+        """Return [(code, name), ...] for a select field."""
+
+        return [(city.code, city.name) for city in self.all()]
+
+    def invalidate(self):
+        """Forget loaded cities; they are reloaded on next use."""
+
+        self._generation += 1
+        self._cities = None
+
+
+# the current app's CityRegistry
+city_registry = LocalProxy(lambda: current_app.extensions['city_registry'])
+
+
 class Cafe(db.Model):
     """Cafe information."""
 
@@ -72,6 +164,32 @@ class Cafe(db.Model):
         default="/static/images/default-cafe.jpg",
     )
 
+    latitude = db.Column(db.Float)
+
+    longitude = db.Column(db.Float)
+
+    # geohash of (latitude, longitude), maintained on save; see geo.py
+    geohash = db.Column(
+        db.String(geo.MAX_PRECISION),
+        index=True,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        index=True,
+    )
+
+    # number of likes, kept up to date by triggers on likes (see below)
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     city = db.relationship("City", backref='cafes')
 
     likes = db.relationship('Like')
@@ -83,9 +201,445 @@ class Cafe(db.Model):
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
-        city = self.city
+        city = city_registry.get(self.city_code) or self.city
         return f'{city.name}, {city.state}'
 
+    EXPORT_FIELDS = (
+        'id',
+        'name',
+        'description',
+        'url',
+        'address',
+        'city_code',
+        'image_url',
+        'latitude',
+        'longitude',
+        'like_count',
+        'updated_at',
+    )
+
+    def serialize(self):
+        """Serialize cafe to a JSON-ready dict."""
+
+        cafe = {field: getattr(self, field) for field in self.EXPORT_FIELDS}
+        cafe['updated_at'] = cafe['updated_at'].isoformat()
+        return cafe
+
+    @classmethod
+    def nearby(cls, lat, lng, radius_km, limit=None):
+        """Return [(cafe, distance_km), ...] within radius_km of (lat, lng),
+        nearest first.
+
+        Only cafes in the geohash cells covering the circle are fetched
+        (an index range scan per cell); exact distances are computed for
+        those candidates alone.
+        """
+
+        query = db.session.query(cls.id, cls.latitude, cls.longitude)
+        cells = geo.covering_cells(lat, lng, radius_km)
+
+        if cells is None:
+            # circle too big for a geohash cell: scan its latitude band
+            lat_delta = radius_km / geo.KM_PER_DEGREE
+            query = query.filter(
+                cls.latitude.between(lat - lat_delta, lat + lat_delta))
+        else:
+            ranges = []
+            for cell in cells:
+                upper = geo.prefix_upper_bound(cell)
+                if upper is None:
+                    ranges.append(cls.geohash >= cell)
+                else:
+                    ranges.append(
+                        db.and_(cls.geohash >= cell, cls.geohash < upper))
+            query = query.filter(db.or_(*ranges))
+
+        distances = []
+        for cafe_id, cafe_lat, cafe_lng in query:
+            if cafe_lat is None or cafe_lng is None:
+                continue
+            distance = geo.distance_km(lat, lng, cafe_lat, cafe_lng)
+            if distance <= radius_km:
+                distances.append((distance, cafe_id))
+
+        distances.sort()
+        if limit is not None:
+            distances = distances[:limit]
+
+        ids = [cafe_id for _, cafe_id in distances]
+        cafes = {cafe.id: cafe for cafe in cls.query.filter(cls.id.in_(ids))}
+        return [(cafes[cafe_id], distance)
+                for distance, cafe_id in distances if cafe_id in cafes]
+
+    @classmethod
+    def nearest(cls, lat, lng, k, max_radius_km):
+        """Return the k nearest [(cafe, distance_km), ...] to (lat, lng),
+        looking no further than max_radius_km.
+
+        Widens the search radius until k cafes are found.
+        """
+
+        radius_km = min(1.0, max_radius_km)
+        while True:
+            found = cls.nearby(lat, lng, radius_km, limit=k)
+            if len(found) >= k or radius_km >= max_radius_km:
+                return found
+            radius_km = min(radius_km * 4, max_radius_km)
+
+    @classmethod
+    def search(cls, terms, page=1, per_page=24):
+        """Full-text search cafe name, description and address.
+
+        Uses the tsvector/GIN index on PostgreSQL and the FTS5 table on
+        SQLite (see the DDL below). Returns (cafes, has_more) for the given
+        1-based page, best match first.
+        """
+
+        dialect = db.session.get_bind().dialect.name
+        limit = per_page + 1
+        offset = (page - 1) * per_page
+
+        if dialect == 'postgresql':
+            rows = db.session.execute(
+                _PG_SEARCH_SQL,
+                dict(terms=terms, limit=limit, offset=offset))
+            ids = [row.id for row in rows]
+
+        elif dialect == 'sqlite':
+            match = _fts5_match(terms)
+            if not match:
+                return [], False
+            rows = db.session.execute(
+                _SQLITE_SEARCH_SQL,
+                dict(terms=match, limit=limit, offset=offset))
+            ids = [row.id for row in rows]
+
+        else:
+            # no full-text index on this backend: scan with ILIKE
+            query = db.session.query(cls.id)
+            for term in terms.split():
+                pattern = f'%{term}%'
+                query = query.filter(db.or_(
+                    cls.name.ilike(pattern),
+                    cls.description.ilike(pattern),
+                    cls.address.ilike(pattern)))
+            rows = query.order_by(cls.name, cls.id).limit(limit).offset(offset)
+            ids = [cafe_id for (cafe_id,) in rows]
+
+        has_more = len(ids) > per_page
+        ids = ids[:per_page]
+
+        cafes = {cafe.id: cafe for cafe in cls.query.filter(cls.id.in_(ids))}
+        return [cafes[cafe_id] for cafe_id in ids if cafe_id in cafes], has_more
+
+    @classmethod
+    def iter_export(cls, city_code=None, updated_since=None, batch_size=1000):
+        """Yield cafes as JSON-ready dicts, ordered by id.
+
+        Rows are streamed from a server-side cursor in batches of
+        `batch_size`, so memory use doesn't grow with the table.
+        """
+
+        columns = [getattr(cls, field) for field in cls.EXPORT_FIELDS]
+        query = db.session.query(*columns)
+
+        if city_code:
+            query = query.filter(cls.city_code == city_code)
+        if updated_since:
+            query = query.filter(cls.updated_at >= updated_since)
+
+        query = (query
+                 .order_by(cls.id)
+                 .execution_options(stream_results=True)
+                 .yield_per(batch_size))
+
+        for row in query:
+            cafe = dict(zip(cls.EXPORT_FIELDS, row))
+            cafe['updated_at'] = cafe['updated_at'].isoformat()
+            yield cafe
+
+    # get_page() orders: {sort: (column, descending)}, with id breaking ties
+    SORTS = {
+        'name': ('name', False),
+        'popular': ('like_count', True),
+    }
+
+    @classmethod
+    def get_page(cls, after=None, before=None, per_page=24, sort='name'):
+        """Return one keyset-paginated page of cafes, ordered by `sort`
+        (by name, or most liked first; see SORTS) then id.
+
+        `after` / `before` are decoded (sort key, id) cursors; pass at most
+        one. Returns (cafes, next_cursor, prev_cursor) where the cursors
+        are encoded tokens, or None when there is no page in that direction.
+        """
+
+        key, descending = cls.SORTS[sort]
+        column = getattr(cls, key)
+
+        def beyond(cursor, forward):
+            """Filter for cafes past cursor, going forward or back."""
+
+            value, cafe_id = cursor
+            key_beyond = (column < value if forward == descending
+                          else column > value)
+            id_beyond = cls.id > cafe_id if forward else cls.id < cafe_id
+            return db.or_(key_beyond, db.and_(column == value, id_beyond))
+
+        def order(forward):
+            key_order = (column.desc() if forward == descending
+                         else column.asc())
+            return key_order, cls.id.asc() if forward else cls.id.desc()
+
+        query = cls.query
+
+        if before:
+            query = query.filter(beyond(before, forward=False))
+            query = query.order_by(*order(forward=False))
+        else:
+            if after:
+                query = query.filter(beyond(after, forward=True))
+            query = query.order_by(*order(forward=True))
+
+        # fetch one extra row to learn if there is a further page
+        cafes = query.limit(per_page + 1).all()
+        has_more = len(cafes) > per_page
+        cafes = cafes[:per_page]
+
+        if before:
+            cafes.reverse()
+            has_next, has_prev = True, has_more
+        else:
+            has_next, has_prev = has_more, bool(after)
+
+        next_cursor = prev_cursor = None
+        if cafes and has_next:
+            next_cursor = encode_cursor(getattr(cafes[-1], key), cafes[-1].id)
+        if cafes and has_prev:
+            prev_cursor = encode_cursor(getattr(cafes[0], key), cafes[0].id)
+
+        return cafes, next_cursor, prev_cursor
+
+    @classmethod
+    def reconcile_like_counts(cls):
+        """Recount every cafe's likes from the likes table, in one UPDATE
+        (fixing counts after e.g. a bulk load). Returns number fixed.
+        """
+
+        counts = (db.select([db.func.count()])
+                  .where(Like.cafe_id == cls.id)
+                  .as_scalar())
+
+        result = db.session.execute(
+            cls.__table__.update()
+            .where(cls.like_count != counts)
+            .values(like_count=counts))
+
+        return result.rowcount
+
+
+# keyset pagination walks these in order (see Cafe.get_page and SORTS)
+db.Index('ix_cafes_name_id', Cafe.name, Cafe.id)
+db.Index('ix_cafes_like_count_desc_id', Cafe.like_count.desc(), Cafe.id)
+
+
+@event.listens_for(Cafe, 'before_insert')
+@event.listens_for(Cafe, 'before_update')
+def _set_cafe_geohash(mapper, connection, cafe):
+    """Keep cafe's geohash in step with its latitude and longitude."""
+
+    if cafe.latitude is None or cafe.longitude is None:
+        cafe.geohash = None
+    else:
+        cafe.geohash = geo.encode(cafe.latitude, cafe.longitude)
+
+
+# Full-text search index for cafes: a generated tsvector column with a GIN
+# index on PostgreSQL, or an external-content FTS5 table kept in sync by
+# triggers on SQLite. The statements are idempotent, so `flask upgrade-db`
+# can run them on an existing database (then SEARCH_REBUILD, to index the
+# cafes already there).
+
+SEARCH_DDL = {
+    'postgresql': [
+        """ALTER TABLE cafes ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+            setweight(
+                to_tsvector('english', coalesce(description, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(address, '')), 'C')
+        ) STORED""",
+        """CREATE INDEX IF NOT EXISTS ix_cafes_search_vector ON cafes
+        USING GIN (search_vector)""",
+    ],
+    'sqlite': [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS cafes_fts USING fts5(
+            name, description, address,
+            content='cafes', content_rowid='id')""",
+        """CREATE TRIGGER IF NOT EXISTS cafes_fts_insert
+        AFTER INSERT ON cafes BEGIN
+            INSERT INTO cafes_fts (rowid, name, description, address)
+            VALUES (new.id, new.name, new.description, new.address);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS cafes_fts_delete
+        AFTER DELETE ON cafes BEGIN
+            INSERT INTO cafes_fts
+                (cafes_fts, rowid, name, description, address)
+            VALUES ('delete', old.id, old.name, old.description, old.address);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS cafes_fts_update
+        AFTER UPDATE OF name, description, address ON cafes BEGIN
+            INSERT INTO cafes_fts
+                (cafes_fts, rowid, name, description, address)
+            VALUES ('delete', old.id, old.name, old.description, old.address);
+            INSERT INTO cafes_fts (rowid, name, description, address)
+            VALUES (new.id, new.name, new.description, new.address);
+        END""",
+    ],
+}
+
+# (PostgreSQL computes the generated column for existing rows itself)
+SEARCH_REBUILD = {
+    'sqlite': ["INSERT INTO cafes_fts (cafes_fts) VALUES ('rebuild')"],
+}
+
+for _dialect, _statements in SEARCH_DDL.items():
+    for _stmt in _statements:
+        event.listen(
+            Cafe.__table__, 'after_create',
+            DDL(_stmt).execute_if(dialect=_dialect))
+
+event.listen(
+    Cafe.__table__, 'before_drop',
+    DDL("DROP TABLE IF EXISTS cafes_fts").execute_if(dialect='sqlite'))
+
+_PG_SEARCH_SQL = db.text("""
+    SELECT id
+    FROM cafes, websearch_to_tsquery('english', :terms) AS query
+    WHERE search_vector @@ query
+    ORDER BY ts_rank(search_vector, query) DESC, id
+    LIMIT :limit OFFSET :offset
+""")
+
+_SQLITE_SEARCH_SQL = db.text("""
+    SELECT rowid AS id
+    FROM cafes_fts
+    WHERE cafes_fts MATCH :terms
+    ORDER BY bm25(cafes_fts, 10.0, 5.0, 1.0), rowid
+    LIMIT :limit OFFSET :offset
+""")
+
+
+def _fts5_match(terms):
+    """Turn user search terms into an FTS5 query matching all of them."""
+
+    return " ".join(
+        '"' + term.replace('"', '""') + '"' for term in terms.split())
+
+
+class UsernameIndex:
+    """Bloom filter of taken usernames (one per app).
+
+    Lets signup skip the database for the usual case of an unused
+    username; a hit still needs checking against the users table.
+    Built off the request path, in a background thread started on first
+    use; until then every username counts as maybe taken. Usernames
+    flushed in this process are added as they are written, and once
+    `max_age` seconds have passed the thread adds users created since
+    (by other processes) rather than rescanning the table. It's only
+    rebuilt when over capacity. Renames by other processes are missed, so
+    the unique constraint is still the final word.
+    """
+
+    def __init__(self, max_age=600, error_rate=0.01, timer=time.monotonic):
+        self.max_age = max_age
+        self.error_rate = error_rate
+        self.timer = timer
+        self._filter = None
+        self._updated_at = None
+        # highest user id added by a scan
+        self._last_id = 0
+        self._updating = False
+        self._lock = threading.Lock()
+
+    def _stale(self, bloom):
+        return bloom is None or bloom.count > bloom.capacity or (
+            self.max_age is not None
+            and self.timer() - self._updated_at >= self.max_age)
+
+    def _start_update(self):
+        """Update the filter in a background thread (inline if the app's
+        USERNAME_INDEX_BACKGROUND is off), unless one already is.
+        """
+
+        with self._lock:
+            if self._updating:
+                return
+            self._updating = True
+
+        app = current_app._get_current_object()
+        if app.config['USERNAME_INDEX_BACKGROUND']:
+            threading.Thread(
+                target=self.update, args=(app,), daemon=True).start()
+        else:
+            self.update()
+
+    def update(self, app=None):
+        """Build the filter if missing or over capacity, else add users
+        created since the last scan.
+        """
+
+        try:
+            if app is not None:
+                with app.app_context():
+                    self._update()
+            else:
+                self._update()
+        finally:
+            self._updating = False
+
+    def _update(self):
+        bloom = self._filter
+        last_id = self._last_id
+        if bloom is None or bloom.count > bloom.capacity:
+            count = db.session.query(db.func.count(User.id)).scalar()
+            bloom = BloomFilter(
+                capacity=max(2 * count, 1000),
+                error_rate=self.error_rate)
+            last_id = 0
+
+        rows = (db.session.query(User.id, User.username)
+                .filter(User.id > last_id)
+                .order_by(User.id)
+                .yield_per(10000))
+        for user_id, username in rows:
+            bloom.add(username)
+            last_id = user_id
+
+        self._filter = bloom
+        self._last_id = last_id
+        self._updated_at = self.timer()
+
+    def might_contain(self, username):
+        """Return False if username is certainly not taken."""
+
+        bloom = self._filter
+        if self._stale(bloom):
+            self._start_update()
+            bloom = self._filter
+        return bloom is None or username in bloom
+
+    def add(self, username):
+        """Record username as taken (if the filter is built)."""
+
+        bloom = self._filter
+        if bloom is not None:
+            bloom.add(username)
+
+
+# the current app's UsernameIndex
+username_index = LocalProxy(lambda: current_app.extensions['username_index'])
+
 
 class User(db.Model):
 
@@ -133,6 +687,24 @@ class User(db.Model):
         """ Get full name of user """
 
         return f'{self.first_name} {self.last_name}'
+
+    def is_liking(self, cafe_id):
+        """Return True if user likes this cafe (a primary key lookup)."""
+
+        q = Like.query.filter_by(cafe_id=cafe_id, user_id=self.id)
+        return db.session.query(q.exists()).scalar()
+
+    def liked_cafe_ids(self, cafe_ids):
+        """Return the subset of cafe_ids that this user likes, as a set."""
+
+        if not cafe_ids:
+            return set()
+
+        rows = (db.session.query(Like.cafe_id)
+                .filter(Like.user_id == self.id,
+                        Like.cafe_id.in_(cafe_ids))
+                .all())
+        return {cafe_id for (cafe_id,) in rows}
     
     def __repr__(self):
         u = self
@@ -140,6 +712,20 @@ class User(db.Model):
 
 
 
+    @classmethod
+    def username_taken(cls, username):
+        """Return True if there's already a user with this username.
+
+        Checked against the username Bloom filter first, so an available
+        username usually costs no query.
+        """
+
+        if not username_index.might_contain(username):
+            return False
+
+        q = cls.query.filter_by(username=username)
+        return db.session.query(q.exists()).scalar()
+
     @classmethod
     def register(
             cls,
@@ -154,9 +740,8 @@ class User(db.Model):
 
         """Register user w/hashed password & return user."""
 
-        hashed = bcrypt.generate_password_hash(password)
-        # turn bytestring into normal (unicode utf8) string
-        hashed_utf8 = hashed.decode("utf8")
+        # hashed off-thread, in the password hashing pool
+        hashed_utf8 = password_hasher.hash(password)
 
         # return instance of user w/username and hashed password
         return cls(
@@ -174,17 +759,67 @@ class User(db.Model):
         """Validate that user exists & password is correct.
 
         Return user if valid; else return False.
+
+        If the stored hash was made at a different bcrypt cost than is now
+        configured, it is replaced with a fresh hash (caller commits).
         """
 
         u = User.query.filter_by(username=username).first()
 
-        if u and bcrypt.check_password_hash(u.hashed_password, pwd):
+        if u and password_hasher.check(u.hashed_password, pwd):
+            if password_hasher.needs_rehash(u.hashed_password):
+                u.hashed_password = password_hasher.hash(pwd)
             # return user instance
             return u
         else:
             return False
 
 
+class UserIdentity:
+    """Lightweight snapshot of the logged-in user, safe to cache per process.
+
+    Holds only the fields templates and views read (never the password
+    hash), and shares User's read-only helper methods.
+    """
+
+    FIELDS = (
+        'id',
+        'username',
+        'email',
+        'first_name',
+        'last_name',
+        'description',
+        'image_url',
+        'admin',
+    )
+
+    def __init__(self, **fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields[field])
+
+    # these only rely on the fields above, so can be shared with User
+    get_full_name = User.get_full_name
+    is_liking = User.is_liking
+    liked_cafe_ids = User.liked_cafe_ids
+
+    def __repr__(self):
+        return f"<UserIdentity: {self.id}, {self.username}>"
+
+    @classmethod
+    def get(cls, user_id):
+        """Load identity for user_id (just the needed columns); None if no
+        such user.
+        """
+
+        columns = [getattr(User, field) for field in cls.FIELDS]
+        row = db.session.query(*columns).filter(User.id == user_id).first()
+
+        if row is None:
+            return None
+
+        return cls(**dict(zip(cls.FIELDS, row)))
+
+
 class Like(db.Model):
     """Mapping of a cafe to a user"""
 
@@ -200,17 +835,370 @@ class Like(db.Model):
                 db.ForeignKey("users.id"),
                 primary_key=True)
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow)
+
+    __table_args__ = (
+        # a user's likes, newest first (see get_page)
+        db.Index('ix_likes_user_id_created_at',
+                 'user_id', 'created_at', 'cafe_id'),
+    )
+
     def __repr__(self):
         like = self
         return f"<Like: {like.cafe_id}, {like.user_id}>"
 
+    @classmethod
+    def add_many(cls, user_id, cafe_ids):
+        """Make user like all of cafe_ids; already-liked and unknown cafes
+        are skipped. Adds to the session; caller commits.
+        """
+
+        if not cafe_ids:
+            return
+
+        columns = ['cafe_id', 'user_id', 'created_at']
+        cafes = (db.select([Cafe.id,
+                            db.literal(user_id),
+                            db.literal(datetime.utcnow(), db.DateTime)])
+                 .where(Cafe.id.in_(cafe_ids)))
+
+        if db.session.get_bind().dialect.name == "postgresql":
+            stmt = (postgresql.insert(cls.__table__)
+                    .from_select(columns, cafes)
+                    .on_conflict_do_nothing())
+        else:
+            already_liked = (db.select([cls.cafe_id])
+                             .where(cls.user_id == user_id))
+            stmt = (cls.__table__.insert()
+                    .from_select(columns,
+                                 cafes.where(Cafe.id.notin_(already_liked))))
+
+        db.session.execute(stmt)
+
+    @classmethod
+    def get_page(cls, user_id, after=None, per_page=24):
+        """Return one keyset-paginated page of the cafes user_id likes,
+        most recently liked first.
+
+        `after` is a decoded (liked_at, cafe_id) cursor. Returns (rows,
+        next_cursor): rows have just id, name, city_code, image_url and
+        liked_at; next_cursor is None on the last page.
+        """
+
+        query = (db.session
+                 .query(Cafe.id,
+                        Cafe.name,
+                        Cafe.city_code,
+                        Cafe.image_url,
+                        cls.created_at.label("liked_at"))
+                 .join(cls, cls.cafe_id == Cafe.id)
+                 .filter(cls.user_id == user_id))
+
+        if after:
+            liked_at, cafe_id = after
+            query = query.filter(db.or_(
+                cls.created_at < liked_at,
+                db.and_(cls.created_at == liked_at, cls.cafe_id < cafe_id)))
+
+        # fetch one extra row to learn if there is a further page
+        rows = (query
+                .order_by(cls.created_at.desc(), cls.cafe_id.desc())
+                .limit(per_page + 1)
+                .all())
+
+        next_cursor = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            last = rows[-1]
+            next_cursor = encode_cursor(last.liked_at.isoformat(), last.id)
+
+        return rows, next_cursor
+
+    @classmethod
+    def remove_many(cls, user_id, cafe_ids):
+        """Make user unlike all of cafe_ids. Caller commits."""
+
+        if not cafe_ids:
+            return
+
+        (cls.query
+            .filter(cls.user_id == user_id, cls.cafe_id.in_(cafe_ids))
+            .delete(synchronize_session=False))
+
+
+class SimilarCafe(db.Model):
+    """A cafe liked by users who like another cafe, precomputed by
+    `flask refresh-similar-cafes` (see recommendations.py).
+    """
+
+    __tablename__ = "similar_cafes"
+
+    cafe_id = db.Column(
+        db.Integer,
+        db.ForeignKey("cafes.id", ondelete="CASCADE"),
+        primary_key=True)
+
+    similar_cafe_id = db.Column(
+        db.Integer,
+        db.ForeignKey("cafes.id", ondelete="CASCADE"),
+        primary_key=True)
+
+    # cosine similarity of the two cafes' likers, in (0, 1]
+    score = db.Column(
+        db.Float,
+        nullable=False)
+
+    def __repr__(self):
+        return (f"<SimilarCafe: {self.cafe_id}, {self.similar_cafe_id}, "
+                f"{self.score:.3f}>")
+
+    @classmethod
+    def get_for(cls, cafe_id, limit=10):
+        """Return up to limit cafes most similar to cafe_id, most similar
+        first: rows with just id, name, city_code, image_url and score.
+        """
+
+        return (db.session
+                .query(Cafe.id,
+                       Cafe.name,
+                       Cafe.city_code,
+                       Cafe.image_url,
+                       cls.score)
+                .join(cls, cls.similar_cafe_id == Cafe.id)
+                .filter(cls.cafe_id == cafe_id)
+                .order_by(cls.score.desc(), Cafe.id)
+                .limit(limit)
+                .all())
+
+
+# DataVersion of the cafes and cities shown by cached pages (see app.py)
+PAGES_VERSION = "pages"
+
+
+class DataVersion(db.Model):
+    """Version number of a set of data (e.g. what cached pages show),
+    bumped in the same transaction as any write to it, so every process
+    sees the change exactly when it's committed.
+    """
+
+    __tablename__ = "data_versions"
+
+    name = db.Column(
+        db.Text,
+        primary_key=True)
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0)
+
+    def __repr__(self):
+        return f"<DataVersion: {self.name}, {self.version}>"
+
+    @classmethod
+    def get(cls, name):
+        """Return current version of name (0 if never bumped)."""
+
+        version = (db.session.query(cls.version)
+                   .filter(cls.name == name)
+                   .scalar())
+        return version or 0
+
+    @classmethod
+    def bump(cls, name, session=None):
+        """Increment version of name in session's (by default, the current
+        session's) transaction.
+        """
+
+        session = session or db.session
+        result = session.execute(
+            cls.__table__.update()
+            .where(cls.name == name)
+            .values(version=cls.version + 1))
+        if not result.rowcount:
+            session.execute(
+                cls.__table__.insert().values(name=name, version=1))
+
+
+class ImportCheckpoint(db.Model):
+    """Number of input rows done by a resumable import (see importer.py),
+    written in the same transaction as the rows themselves.
+    """
+
+    __tablename__ = "import_checkpoints"
+
+    name = db.Column(
+        db.Text,
+        primary_key=True)
+
+    rows_done = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0)
+
+    def __repr__(self):
+        return f"<ImportCheckpoint: {self.name}, {self.rows_done}>"
+
+    @classmethod
+    def get(cls, name):
+        """Return rows done by import name (0 if never checkpointed)."""
+
+        rows_done = (db.session.query(cls.rows_done)
+                     .filter(cls.name == name)
+                     .scalar())
+        return rows_done or 0
+
+    @classmethod
+    def set(cls, name, rows_done):
+        """Record rows done by import name. Caller commits."""
+
+        result = db.session.execute(
+            cls.__table__.update()
+            .where(cls.name == name)
+            .values(rows_done=rows_done))
+        if not result.rowcount:
+            db.session.execute(
+                cls.__table__.insert().values(name=name, rows_done=rows_done))
+
+
+# Cafe.like_count (and updated_at, so incremental exports see the new
+# count) is kept up to date by triggers on likes. (On other databases, run
+# `flask reconcile-like-counts` after changing likes.) Each list drops the
+# triggers first, so `flask upgrade-db` can rerun it to replace them.
+
+LIKE_COUNT_TRIGGERS = {
+    'postgresql': [
+        "DROP TRIGGER IF EXISTS likes_like_count ON likes",
+        """CREATE OR REPLACE FUNCTION likes_update_like_count()
+        RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE cafes SET like_count = like_count + 1,
+                    updated_at = now() AT TIME ZONE 'utc'
+                WHERE id = NEW.cafe_id;
+            ELSE
+                UPDATE cafes SET like_count = like_count - 1,
+                    updated_at = now() AT TIME ZONE 'utc'
+                WHERE id = OLD.cafe_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql""",
+        """CREATE TRIGGER likes_like_count AFTER INSERT OR DELETE ON likes
+        FOR EACH ROW EXECUTE PROCEDURE likes_update_like_count()""",
+    ],
+    'sqlite': [
+        "DROP TRIGGER IF EXISTS likes_like_count_insert",
+        "DROP TRIGGER IF EXISTS likes_like_count_delete",
+        """CREATE TRIGGER likes_like_count_insert AFTER INSERT ON likes BEGIN
+            UPDATE cafes SET like_count = like_count + 1,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = new.cafe_id;
+        END""",
+        """CREATE TRIGGER likes_like_count_delete AFTER DELETE ON likes BEGIN
+            UPDATE cafes SET like_count = like_count - 1,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = old.cafe_id;
+        END""",
+    ],
+}
+
+for _dialect, _statements in LIKE_COUNT_TRIGGERS.items():
+    for _stmt in _statements:
+        event.listen(
+            Like.__table__, 'after_create',
+            DDL(_stmt).execute_if(dialect=_dialect))
+
+
+def invalidate_cities_on_commit(session):
+    """Reload city registry once session commits (not if it rolls back)."""
+
+    session.info['cities_written'] = True
+
+
+@event.listens_for(db.session, 'after_flush')
+def _invalidate_cities_after_flush(session, flush_context):
+    """Reload city registry on commit if any City was written in this flush."""
+
+    written = session.new | session.dirty | session.deleted
+    if any(isinstance(obj, City) for obj in written):
+        invalidate_cities_on_commit(session)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _add_new_usernames_after_flush(session, flush_context):
+    """Add usernames of users created or renamed in this flush to the
+    Bloom filter.
+    """
+
+    for obj in session.new:
+        if isinstance(obj, User):
+            username_index.add(obj.username)
+
+    for obj in session.dirty:
+        if (isinstance(obj, User)
+                and inspect(obj).attrs.username.history.has_changes()):
+            username_index.add(obj.username)
+
+
+@event.listens_for(db.session, 'after_bulk_update')
+@event.listens_for(db.session, 'after_bulk_delete')
+def _invalidate_cities_after_bulk(context):
+    """Reload city registry on commit after a bulk update/delete of cities."""
+
+    if context.mapper.class_ is City:
+        invalidate_cities_on_commit(context.session)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_cities_after_commit(session):
+    """Reload city registry if this transaction wrote any City."""
+
+    if session.info.pop('cities_written', False):
+        city_registry.invalidate()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _keep_cities_after_rollback(session):
+    """Rolled back city writes leave the city registry as it was."""
+
+    session.info.pop('cities_written', None)
+
+
+def encode_cursor(*values):
+    """Encode key values into an opaque, url-safe pagination cursor."""
+
+    raw = json.dumps(values, separators=(',', ':')).encode("utf8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor into a list of key values.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+    if not isinstance(values, list):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+    return values
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
     You should call this in your Flask app.
     """
 
-    db.app = app
     db.init_app(app)
 
 
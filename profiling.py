@@ -0,0 +1,222 @@
+"""Opt-in request profiling for Flask Cafe.
+
+Two ways of catching slow code paths in production:
+
+- PROFILE_SAMPLE_RATE: this fraction of requests is run under cProfile,
+  saved as a .pstats file (open with `python -m pstats` or snakeviz).
+
+- PROFILE_SLOW_SECONDS: requests still running after this long have their
+  stack sampled every PROFILE_SAMPLE_INTERVAL seconds by a background
+  thread, saved as a .collapsed file (one "outer;...;inner count" line per
+  stack, as read by flamegraph.pl or speedscope). Requests that finish in
+  time cost almost nothing.
+
+Profiles go to PROFILE_DIR, keeping only the newest PROFILE_MAX_FILES, and
+admins can list and download them at /admin/profiles.
+"""
+
+import cProfile
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime
+
+from flask import current_app, g
+from werkzeug.local import LocalProxy
+
+from metrics import endpoint_name
+
+ProfileInfo = namedtuple("ProfileInfo", "name size modified")
+
+# names of profiles we wrote, so downloads can't reach other files
+PROFILE_NAME_RE = re.compile(r"^[\w.-]+\.(pstats|collapsed)$")
+
+
+class ProfileStore:
+    """Directory of profiles, keeping only the newest max_files."""
+
+    def __init__(self, directory=None, max_files=50):
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    def save(self, endpoint, seconds, extension, write):
+        """Save a profile made by calling write(path); return its name."""
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        name = f"{stamp}-{endpoint}-{seconds * 1000:.0f}ms.{extension}"
+        path = os.path.join(self.directory, name)
+
+        tmp_path = f"{path}.tmp"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            for old in self.list()[self.max_files:]:
+                try:
+                    os.remove(os.path.join(self.directory, old.name))
+                except FileNotFoundError:
+                    pass
+
+        return name
+
+    def list(self):
+        """Return ProfileInfo for each profile, newest first."""
+
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+
+        profiles = []
+        for entry in os.scandir(self.directory):
+            if PROFILE_NAME_RE.match(entry.name):
+                stat = entry.stat()
+                profiles.append(ProfileInfo(
+                    entry.name,
+                    stat.st_size,
+                    datetime.utcfromtimestamp(stat.st_mtime)))
+
+        # names start with a timestamp
+        return sorted(profiles, key=lambda info: info.name, reverse=True)
+
+    def path(self, name):
+        """Return path of profile called name, or None if there isn't one."""
+
+        if not self.directory or not PROFILE_NAME_RE.match(name):
+            return None
+
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Background thread sampling the stacks of requests that run slow."""
+
+    def __init__(self, interval=0.005):
+        self._lock = threading.Lock()
+        # thread id -> [started, slow_after, Counter of collapsed stacks]
+        self._watched = {}
+        self._thread = None
+        self._thread_pid = None
+        self.interval = interval
+
+    def watch(self, slow_after):
+        """Start watching the calling thread, sampling its stack once it's
+        been running for slow_after seconds.
+        """
+
+        self._ensure_thread()
+        with self._lock:
+            self._watched[threading.get_ident()] = [
+                time.perf_counter(), slow_after, Counter()]
+
+    def unwatch(self):
+        """Stop watching calling thread; return Counter of its stacks."""
+
+        with self._lock:
+            watched = self._watched.pop(threading.get_ident(), None)
+        return watched[2] if watched else Counter()
+
+    def _ensure_thread(self):
+        with self._lock:
+            # threads don't survive into forked worker processes
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(
+                    target=self._run, name="stack-sampler", daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+
+            with self._lock:
+                due = {ident: stacks
+                       for ident, (started, slow_after, stacks)
+                       in self._watched.items()
+                       if now - started >= slow_after}
+            if not due:
+                continue
+
+            frames = sys._current_frames()
+            for ident, stacks in due.items():
+                frame = frames.get(ident)
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                if labels:
+                    stacks[";".join(reversed(labels))] += 1
+
+
+# the current app's ProfileStore
+profile_store = LocalProxy(lambda: current_app.extensions['profiles'])
+
+
+def _write_collapsed(stacks):
+    def write(path):
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    return write
+
+
+def init_app(app):
+    """Profile app's requests as configured (if at all)."""
+
+    profiles = app.extensions['profiles'] = ProfileStore(
+        directory=app.config['PROFILE_DIR'],
+        max_files=app.config['PROFILE_MAX_FILES'],
+    )
+    stack_sampler = StackSampler(app.config['PROFILE_SAMPLE_INTERVAL'])
+
+    @app.before_request
+    def start_profiling():
+        if not app.config['PROFILE_DIR']:
+            return
+
+        sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        slow_seconds = app.config['PROFILE_SLOW_SECONDS']
+        g.profile_started = time.perf_counter()
+
+        if sample_rate and random.random() < sample_rate:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        elif slow_seconds is not None:
+            stack_sampler.watch(slow_seconds)
+            g.profile_sampled = True
+
+    @app.teardown_request
+    def save_profile(exc):
+        if 'profile_started' not in g:
+            return
+
+        seconds = time.perf_counter() - g.profile_started
+        endpoint = endpoint_name()
+
+        try:
+            if 'profiler' in g:
+                g.profiler.disable()
+                profiles.save(
+                    endpoint, seconds, "pstats", g.profiler.dump_stats)
+            elif g.get('profile_sampled'):
+                stacks = stack_sampler.unwatch()
+                if stacks:
+                    profiles.save(
+                        endpoint, seconds, "collapsed",
+                        _write_collapsed(stacks))
+        except OSError:
+            app.logger.exception("Couldn't save profile")
@@ -0,0 +1,143 @@
+"""Token-bucket rate limiting for Flask Cafe.
+
+Views decorated with @rate_limiter.limit("name") allow each client a burst
+of requests, refilled at a steady rate, as configured in RATELIMITS:
+
+    RATELIMITS = {"login": "10/minute", "likes": "60/minute"}
+
+("N/period" allows bursts of N, refilled at N per period.) A client is
+limited both by IP and, if logged in, by user; a request only spends a
+token from each bucket if every one of them has one. Over the limit, the
+view returns 429 with a Retry-After header.
+
+Behind a reverse proxy, set PROXY_FIX_X_FOR (see create_app) so the IP is
+the client's, not the proxy's.
+
+Buckets live in each app's TokenBucketStore, set up by init_app();
+MemoryTokenBucketStore keeps them in process, evicting the least recently
+used beyond RATELIMIT_MAX_KEYS. A shared store (e.g. Redis) can be passed
+to init_app() instead, by implementing take_all().
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, request
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+
+
+def parse_limit(limit):
+    """Parse "N/period" into (rate per second, burst)."""
+
+    count, period = limit.split('/')
+    count = int(count)
+    return count / PERIODS[period.strip()], count
+
+
+class TokenBucketStore:
+    """Interface for storage of token buckets."""
+
+    def take_all(self, keys, rate, burst):
+        """Take a token from each of buckets `keys` (refilling at `rate` per
+        second, holding at most `burst`), or from none of them unless all
+        have one.
+
+        Return (allowed, retry_after seconds).
+        """
+
+        raise NotImplementedError
+
+    def take(self, key, rate, burst):
+        """Take a token from bucket `key`; see take_all()."""
+
+        return self.take_all([key], rate, burst)
+
+
+class MemoryTokenBucketStore(TokenBucketStore):
+    """In-process token buckets, evicting idle keys beyond max_keys."""
+
+    def __init__(self, max_keys=100000, timer=time.monotonic):
+        self.max_keys = max_keys
+        self.timer = timer
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take_all(self, keys, rate, burst):
+        now = self.timer()
+
+        with self._lock:
+            tokens = {}
+            for key in keys:
+                held, updated = self._buckets.pop(key, (burst, now))
+                tokens[key] = min(burst, held + (now - updated) * rate)
+
+            short = [held for held in tokens.values() if held < 1]
+            if short:
+                allowed, retry_after = False, (1 - min(short)) / rate
+            else:
+                allowed, retry_after = True, 0
+
+            # re-inserting makes these keys the most recently used
+            for key, held in tokens.items():
+                self._buckets[key] = (held - 1 if allowed else held, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        return allowed, retry_after
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RateLimiter:
+    """Rate limits views per client, using key_func to name the client(s)
+    making a request.
+    """
+
+    def __init__(self, key_func):
+        self.key_func = key_func
+
+    def init_app(self, app, store=None):
+        """Give app its token bucket store (by default, in memory)."""
+
+        app.extensions['ratelimit'] = store or MemoryTokenBucketStore(
+            max_keys=app.config['RATELIMIT_MAX_KEYS'])
+
+    def limit(self, name, methods=("POST",)):
+        """Decorate view to rate limit requests made with these methods
+        under the RATELIMITS[name] limit.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                config = current_app.config
+                if (config['RATELIMIT_ENABLED']
+                        and request.method in methods
+                        and name in config['RATELIMITS']):
+                    rate, burst = parse_limit(config['RATELIMITS'][name])
+                    store = current_app.extensions['ratelimit']
+
+                    allowed, retry_after = store.take_all(
+                        [f"{name}:{key}" for key in self.key_func()],
+                        rate, burst)
+                    if not allowed:
+                        return Response(
+                            'Too many requests; please slow down.',
+                            429,
+                            {'Retry-After': str(math.ceil(retry_after))})
+
+                return view(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
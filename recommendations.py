@@ -0,0 +1,139 @@
+""""Users who liked this also liked" recommendations for Flask Cafe.
+
+Likes make a users x cafes matrix X, with a 1 where a user likes a cafe.
+Two cafes are similar when the same users like them; their score is the
+cosine similarity of their columns of X:
+
+    common likers / sqrt(likers of one * likers of the other)
+
+which the sparse product X'X gives for every pair of cafes at once. Each
+cafe's most similar cafes are stored in the similar_cafes table (see
+SimilarCafe), so pages only ever read that.
+
+Run this on a schedule (e.g. hourly, from cron):
+
+    flask refresh-similar-cafes
+
+It recomputes every score, but only rewrites the cafes whose similar
+cafes changed.
+
+Needs NumPy and SciPy (imported only when refreshing).
+"""
+
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models import db, Like, SimilarCafe
+
+# cafes per DELETE ... WHERE cafe_id IN (...)
+DELETE_CHUNK_SIZE = 500
+
+
+def similar_cafes(likes, top_k=10):
+    """Return {cafe id: [(similar cafe id, score), ...]}, most similar (then
+    lowest id) first, at most top_k each, from (user id, cafe id) likes.
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    likes = np.asarray(likes, dtype=np.int64).reshape(-1, 2)
+    if not len(likes):
+        return {}
+
+    user_ids, users = np.unique(likes[:, 0], return_inverse=True)
+    cafe_ids, cafes = np.unique(likes[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(likes)), (users, cafes)),
+        shape=(len(user_ids), len(cafe_ids)))
+
+    # common[a, b]: number of users liking both cafe a and cafe b
+    common = (matrix.T @ matrix).tocsr()
+    likers = common.diagonal()
+    common.setdiag(0)
+    common.eliminate_zeros()
+
+    rows = np.repeat(np.arange(len(cafe_ids)), np.diff(common.indptr))
+    cols = common.indices
+    scores = common.data / np.sqrt(likers[rows] * likers[cols])
+
+    # rank each row's entries, best first, and keep the first top_k
+    order = np.lexsort((cafe_ids[cols], -scores, rows))
+    rank = np.arange(len(order)) - np.repeat(
+        common.indptr[:-1], np.diff(common.indptr))
+    keep = order[rank < top_k]
+
+    similar = {}
+    for row, col, score in zip(
+            cafe_ids[rows[keep]].tolist(),
+            cafe_ids[cols[keep]].tolist(),
+            scores[keep].tolist()):
+        similar.setdefault(row, []).append((col, score))
+    return similar
+
+
+def _unchanged(old, new):
+    """Return True if two [(cafe id, score), ...] lists match."""
+
+    def key(pairs):
+        return {cafe_id: round(score, 6) for cafe_id, score in pairs}
+
+    return key(old) == key(new)
+
+
+def refresh_similar_cafes(top_k=10):
+    """Recompute every cafe's similar cafes from likes, rewriting only those
+    that changed; return how many cafes changed. Caller commits.
+    """
+
+    likes = db.session.query(Like.user_id, Like.cafe_id).all()
+    new = similar_cafes(likes, top_k)
+
+    old = {}
+    for row in db.session.query(SimilarCafe.cafe_id,
+                                SimilarCafe.similar_cafe_id,
+                                SimilarCafe.score):
+        old.setdefault(row.cafe_id, []).append(
+            (row.similar_cafe_id, row.score))
+
+    changed = sorted(
+        cafe_id for cafe_id in old.keys() | new.keys()
+        if not _unchanged(old.get(cafe_id, []), new.get(cafe_id, [])))
+
+    for i in range(0, len(changed), DELETE_CHUNK_SIZE):
+        (SimilarCafe.query
+            .filter(SimilarCafe.cafe_id.in_(
+                changed[i:i + DELETE_CHUNK_SIZE]))
+            .delete(synchronize_session=False))
+
+    rows = [{"cafe_id": cafe_id, "similar_cafe_id": similar_id,
+             "score": score}
+            for cafe_id in changed
+            for similar_id, score in new.get(cafe_id, [])]
+    if rows:
+        db.session.execute(SimilarCafe.__table__.insert(), rows)
+
+    return len(changed)
+
+
+@click.command('refresh-similar-cafes')
+@click.option('--top-k', type=int,
+              help="Similar cafes kept per cafe (default: SIMILAR_CAFES).")
+@with_appcontext
+def refresh_similar_cafes_command(top_k):
+    """Recompute "users who liked this also liked" cafes from likes."""
+
+    started = time.monotonic()
+    try:
+        changed = refresh_similar_cafes(
+            top_k or current_app.config['SIMILAR_CAFES'])
+    except ImportError:
+        raise click.ClickException(
+            "refresh-similar-cafes needs numpy and scipy installed")
+    db.session.commit()
+
+    elapsed = time.monotonic() - started
+    click.echo(f"Done: {changed} cafes changed ({elapsed:.1f}s)")
@@ -1,15 +1,10 @@
 """Initial data."""
 
-from models import City, Cafe, db, connect_db, User, Like
-from flask import Flask
+from models import City, Cafe, db, User, Like
+from app import create_app
 
-app = Flask(__name__)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres:///flaskcafe'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-
-connect_db(app)
+app = create_app()
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -36,7 +31,9 @@ c1 = Cafe(
     address="3966 24th St",
     city_code='sf',
     url='https://www.yelp.com/biz/bernies-san-francisco',
-    image_url='https://s3-media4.fl.yelpcdn.com/bphoto/bVCa2JefOCqxQsM6yWrC-A/o.jpg'
+    image_url='https://s3-media4.fl.yelpcdn.com/bphoto/bVCa2JefOCqxQsM6yWrC-A/o.jpg',
+    latitude=37.7516,
+    longitude=-122.4320,
 )
 
 c2 = Cafe(
@@ -47,6 +44,8 @@ c2 = Cafe(
     city_code='oak',
     url='https://perchoffee.com',
     image_url='https://s3-media4.fl.yelpcdn.com/bphoto/0vhzcgkzIUIEPIyL2rF_YQ/o.jpg',
+    latitude=37.8119,
+    longitude=-122.2581,
 )
 
 db.session.add_all([c1, c2])
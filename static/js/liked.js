@@ -1,43 +1,42 @@
-async function likeCafes(){
-    let response = await axios.get(`/api/likes?cafe_id=${window.location.pathname.split("/")[2]}`)
-    if (response.data.likes){
-        $("#liked").text("Liked")
-        $("#liked").addClass("btn-primary")
-    } else {
-        $("#liked").text("Like")
-        $("#liked").addClass("btn-outline-primary")
-    }
+// The like button is rendered with the user's like state, so the API is
+// only called when it's clicked.
+
+const $liked = $("#liked")
+const cafeId = $liked.data("cafe-id")
+
+function showLiked(liked){
+    $liked.text(liked ? "Liked" : "Like")
+    $liked.toggleClass("btn-primary", liked)
+    $liked.toggleClass("btn-outline-primary", !liked)
 }
 
-likeCafes();
+function addToCount(change){
+    const $count = $("#like-count")
+    $count.text(Number($count.text()) + change)
+}
 
 async function likeNewCafe(){
-    let response = await axios.post("/api/like", {"cafe_id": window.location.pathname.split("/")[2]})
+    let response = await axios.post("/api/like", {"cafe_id": cafeId})
     if (response.data.liked){
-        $("#liked").removeClass("btn-outline-primary")
-        $("#liked").text("Liked")
-        $("#liked").addClass("btn-primary")
+        showLiked(true)
+        addToCount(1)
     }
 }
 
 
 async function unLikeCafe(){
-    let response = await axios.post("/api/unlike", {"cafe_id": window.location.pathname.split("/")[2]})
-    $("#liked").removeClass("btn-primary")
+    let response = await axios.post("/api/unlike", {"cafe_id": cafeId})
     if (response.data.unliked){
-        $("#liked").removeClass("btn-primary")
-        $("#liked").text("Like")
-        $("#liked").addClass("btn-outline-primary")
-    }    
+        showLiked(false)
+        addToCount(-1)
+    }
 }
 
 
-
-$("#liked").on('click', function(evt){
-    // debugger;
-    if($("#liked").text() === "Like"){
+$liked.on('click', function(evt){
+    if($liked.text().trim() === "Like"){
         likeNewCafe()
     } else {
         unLikeCafe()
     }
-})
\ No newline at end of file
+})
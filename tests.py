@@ -1,25 +1,41 @@
 """Tests for Flask Cafe."""
 
 
+import gzip
+import io
+import json
+import os
 import re
+import shutil
+import tempfile
+import time
+from datetime import datetime
 from unittest import TestCase
-
-from flask import session
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, User#, Like
-
-# Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///flaskcafe-test"
-app.config['SQLALCHEMY_ECHO'] = False
-
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
+from PIL import Image
+
+from flask import session, render_template_string
+from app import create_app, user_cache, rate_limit_keys, CURR_USER_KEY
+from models import db, Cafe, City, User, Like, SimilarCafe, city_registry
+from models import DataVersion, ImportCheckpoint, PAGES_VERSION
+from models import UsernameIndex
+from cache import BloomFilter, LRUCache
+from config import DevelopmentConfig, ProductionConfig, TestConfig
+from dbrouting import PRIMARY_UNTIL_KEY, reading_primary
+from hashing import HashingBusy, password_hasher
+from ratelimit import MemoryTokenBucketStore
+from instrumentation import endpoint_stats, query_budget, QueryBudgetExceeded
+import assets
+from metrics import registry
+from thumbnails import fetch_public_url, thumbnailer
+from leaderboard import Leaderboard, leaderboard
+from recommendations import similar_cafes
+
+# The test profile uses the test database, doesn't clutter tests with SQL or
+# the debug toolbar, makes Flask errors real errors, and doesn't req CSRF
+app = create_app("test")
+
+# Run model code in tests against this app's database
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -111,6 +127,345 @@ TEST_USER_DATA_NEW = dict(
 # )
 
 
+#######################################
+# caches
+
+
+class BloomFilterTestCase(TestCase):
+    """Tests for the Bloom filter."""
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(capacity=100)
+        for i in range(100):
+            bloom.add(f"user{i}")
+
+        self.assertTrue(all(f"user{i}" in bloom for i in range(100)))
+        false_positives = sum(f"other{i}" in bloom for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+
+class LRUCacheTestCase(TestCase):
+    """Tests for in-process LRU cache."""
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl(self):
+        now = [0]
+        cache = LRUCache(ttl=10, timer=lambda: now[0])
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+
+        now[0] = 10
+        self.assertIsNone(cache.get("a"))
+
+
+#######################################
+# rate limiting
+
+
+class RateLimitTestCase(TestCase):
+    """Tests for token-bucket rate limiting."""
+
+    def test_token_bucket(self):
+        now = [0]
+        store = MemoryTokenBucketStore(max_keys=2, timer=lambda: now[0])
+
+        self.assertEqual(store.take("a", rate=1, burst=2), (True, 0))
+        self.assertEqual(store.take("a", rate=1, burst=2), (True, 0))
+        self.assertEqual(store.take("a", rate=1, burst=2), (False, 1))
+
+        now[0] = 1
+        self.assertEqual(store.take("a", rate=1, burst=2), (True, 0))
+
+        store.take("b", rate=1, burst=2)
+        store.take("c", rate=1, burst=2)
+        self.assertEqual(len(store), 2)
+
+    def test_take_all(self):
+        store = MemoryTokenBucketStore(timer=lambda: 0)
+        store.take("user", rate=1, burst=1)
+
+        # the user bucket is empty, so the ip bucket isn't spent either
+        self.assertEqual(
+            store.take_all(["ip", "user"], rate=1, burst=1), (False, 1))
+        self.assertEqual(store.take("ip", rate=1, burst=1), (True, 0))
+
+    def test_client_ip_behind_proxy(self):
+        class ProxyConfig(TestConfig):
+            PROXY_FIX_X_FOR = 1
+
+        for config, ip in [(TestConfig, "10.0.0.1"),
+                           (ProxyConfig, "203.0.113.7")]:
+            ip_app = create_app(config)
+            ip_app.add_url_rule(
+                "/test-ip", "test_ip", lambda: rate_limit_keys()[0])
+
+            resp = ip_app.test_client().get(
+                "/test-ip",
+                headers={"X-Forwarded-For": "203.0.113.7"},
+                environ_base={"REMOTE_ADDR": "10.0.0.1"})
+            self.assertEqual(resp.data.decode(), f"ip:{ip}")
+
+
+#######################################
+# app factory
+
+
+class CreateAppTestCase(TestCase):
+    """Tests for building apps from config profiles."""
+
+    def test_profiles(self):
+        dev_app = create_app(DevelopmentConfig)
+        self.assertTrue(dev_app.config['SQLALCHEMY_ECHO'])
+        self.assertIn('debugtoolbar', dev_app.blueprints)
+
+        self.assertFalse(app.config['SQLALCHEMY_ECHO'])
+        self.assertNotIn('debugtoolbar', app.blueprints)
+
+        # making an app doesn't change the ones already made
+        self.assertTrue(dev_app.extensions['thumbnailer'].enabled)
+        self.assertFalse(thumbnailer.enabled)
+        for name in ('user_cache', 'city_registry', 'username_index'):
+            self.assertIsNot(dev_app.extensions[name], app.extensions[name])
+
+    def test_default_profile(self):
+        # production, which won't start without a secret key
+        if ProductionConfig.SECRET_KEY:
+            self.skipTest("FLASK_SECRET_KEY is set")
+
+        environ = os.environ.pop('FLASK_CONFIG', None)
+        try:
+            with self.assertRaises(RuntimeError):
+                create_app()
+        finally:
+            if environ is not None:
+                os.environ['FLASK_CONFIG'] = environ
+
+    def test_server_timing(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            self.assertRegex(
+                resp.headers["Server-Timing"],
+                r'db;dur=[\d.]+;desc="\d+ queries", app;dur=[\d.]+')
+
+        stats = endpoint_stats()["cafe_list"]
+        self.assertGreater(stats["queries"]["count"], 0)
+
+    def test_metrics(self):
+        with app.test_client() as client:
+            client.get("/cafes")
+            resp = client.get("/metrics")
+
+        self.assertEqual(resp.status_code, 200)
+        body = resp.get_data(as_text=True)
+        self.assertIn("# TYPE flaskcafe_requests_total counter", body)
+        self.assertRegex(
+            body,
+            r'flaskcafe_requests_total\{endpoint="cafe_list",method="GET",'
+            r'status="200"\} [1-9]')
+        self.assertIn(
+            'flaskcafe_request_duration_seconds_bucket{endpoint="cafe_list",'
+            'le="+Inf"}', body)
+
+    def test_metrics_across_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # another (exited) worker's counts are added in
+            with open(os.path.join(directory, "metrics-1.json"), "w") as f:
+                json.dump({"pid": 1, "metrics": [{
+                    "name": "flaskcafe_likes_total",
+                    "help": "Cafes liked and unliked.",
+                    "type": "counter",
+                    "samples": [["flaskcafe_likes_total",
+                                 {"action": "test"}, 5]],
+                }]}, f)
+
+            # a long exited one's file is folded into the exited processes'
+            # totals (4194305 > any pid_max)
+            stale_path = os.path.join(directory, "metrics-4194305-1.json")
+            with open(stale_path, "w") as f:
+                json.dump({"pid": 4194305, "started": 1, "metrics": [{
+                    "name": "flaskcafe_likes_total",
+                    "help": "Cafes liked and unliked.",
+                    "type": "counter",
+                    "samples": [["flaskcafe_likes_total",
+                                 {"action": "test"}, 100]],
+                }]}, f)
+            os.utime(stale_path, (time.time() - 600, time.time() - 600))
+
+            registry.get("flaskcafe_likes_total").labels("test").inc(2)
+            body = registry.render(directory, stale_after=300)
+            self.assertIn('flaskcafe_likes_total{action="test"} 107', body)
+            self.assertFalse(os.path.exists(stale_path))
+
+            # ...and stays counted, once
+            body = registry.render(directory, stale_after=300)
+            self.assertIn('flaskcafe_likes_total{action="test"} 107', body)
+
+    def test_query_budget(self):
+        budget_app = create_app("test")
+
+        @budget_app.route("/test-query-budget")
+        @query_budget(1)
+        def too_many_queries():
+            City.query.all()
+            City.query.all()
+            return "done"
+
+        with budget_app.test_client() as client:
+            with self.assertRaises(QueryBudgetExceeded):
+                client.get("/test-query-budget")
+
+    def test_failed_query_timing(self):
+        conn = db.session.connection()
+        with self.assertRaises(Exception):
+            conn.execute("SELECT * FROM no_such_table")
+        # the failed query's start time isn't left behind
+        self.assertEqual(conn.info['query_started'], [])
+        db.session.rollback()
+
+    def test_production_needs_secret_key(self):
+        class NoSecretConfig(ProductionConfig):
+            SECRET_KEY = None
+
+        with self.assertRaises(RuntimeError):
+            create_app(NoSecretConfig)
+
+
+#######################################
+# profiling
+
+
+class ProfilingTestCase(TestCase):
+    """Tests for request profiling and the admin views of profiles."""
+
+    def setUp(self):
+        User.query.delete()
+        admin = User.register(**TEST_USER_DATA, admin=True)
+        db.session.add(admin)
+        db.session.commit()
+        self.admin_id = admin.id
+
+        self.profile_dir = tempfile.TemporaryDirectory()
+
+        class ProfilingConfig(TestConfig):
+            PROFILE_DIR = self.profile_dir.name
+            PROFILE_MAX_FILES = 2
+            PROFILE_SAMPLE_RATE = 1
+
+        self.app = create_app(ProfilingConfig)
+
+    def tearDown(self):
+        User.query.delete()
+        db.session.commit()
+        user_cache.clear()
+        self.profile_dir.cleanup()
+
+    def test_sampled_requests(self):
+        with self.app.test_client() as client:
+            for i in range(3):
+                client.get("/")
+
+            do_login(client, self.admin_id)
+            resp = client.get("/admin/profiles")
+            names = re.findall(r'/admin/profiles/([\w.-]+\.pstats)',
+                               resp.get_data(as_text=True))
+            # only the newest are kept
+            self.assertEqual(len(names), 2)
+
+            resp = client.get(f"/admin/profiles/{names[0]}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("attachment", resp.headers["Content-Disposition"])
+
+            resp = client.get("/admin/profiles/..%2Fsecret.pstats")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_slow_requests(self):
+        self.app.config['PROFILE_SAMPLE_RATE'] = 0
+        self.app.config['PROFILE_SLOW_SECONDS'] = 0.01
+
+        @self.app.route("/test-slow")
+        def slow_view():
+            time.sleep(0.1)
+            return "done"
+
+        with self.app.test_client() as client:
+            client.get("/test-slow")
+
+        [name] = os.listdir(self.profile_dir.name)
+        self.assertRegex(name, r"-slow_view-\d+ms\.collapsed$")
+        with open(os.path.join(self.profile_dir.name, name)) as f:
+            self.assertIn(";slow_view (", f.read())
+
+    def test_admin_only(self):
+        User.query.get(self.admin_id).admin = False
+        db.session.commit()
+
+        with self.app.test_client() as client:
+            resp = client.get("/admin/profiles")
+            self.assertEqual(resp.status_code, 302)
+
+            do_login(client, self.admin_id)
+            resp = client.get("/admin/profiles")
+            self.assertEqual(resp.status_code, 401)
+
+
+#######################################
+# static assets
+
+
+class AssetsTestCase(TestCase):
+    """Tests for fingerprinted, precompressed static assets."""
+
+    def setUp(self):
+        self.static_dir = tempfile.TemporaryDirectory()
+        static_folder = os.path.join(self.static_dir.name, "static")
+        shutil.copytree(app.static_folder, static_folder,
+                        ignore=shutil.ignore_patterns("dist"))
+
+        self.app = create_app("test")
+        self.app.static_folder = static_folder
+
+    def tearDown(self):
+        self.static_dir.cleanup()
+
+    def test_build_assets(self):
+        with self.app.test_client() as client:
+            # before a build, plain static URLs
+            with self.app.test_request_context():
+                self.assertEqual(
+                    render_template_string("{{ asset_url('js/liked.js') }}"),
+                    "/static/js/liked.js")
+
+            result = self.app.test_cli_runner().invoke(args=["build-assets"])
+            self.assertIn("Done:", result.output)
+            assets.init_app(self.app)
+
+            with self.app.test_request_context():
+                url = render_template_string("{{ asset_url('js/liked.js') }}")
+            self.assertRegex(url, r"^/static/dist/js/liked\.[0-9a-f]{12}\.js$")
+
+            resp = client.get(url, headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertIn("javascript", resp.content_type)
+            with open(os.path.join(self.app.static_folder, "js/liked.js"),
+                      "rb") as f:
+                self.assertEqual(gzip.decompress(resp.data), f.read())
+
+            resp = client.get(url)
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+
+
 #######################################
 # homepage
 
@@ -157,6 +512,24 @@ class CityModelTestCase(TestCase):
     # depending on how you solve exercise, you may have things to test on
     # the City model, so here's a good place to put that stuff.
 
+    def test_city_registry(self):
+        self.assertEqual(city_registry.choices(), [("sf", "San Francisco")])
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.commit()
+
+        self.assertEqual(city_registry.get("oak").name, "Oakland")
+        self.assertEqual(
+            city_registry.choices(),
+            [("oak", "Oakland"), ("sf", "San Francisco")])
+
+        # a rolled back write doesn't invalidate (or show up)
+        db.session.add(City(code="sj", name="San Jose", state="CA"))
+        db.session.flush()
+        db.session.rollback()
+        self.assertIsNotNone(city_registry._cities)
+        self.assertIsNone(city_registry.get("sj"))
+
 
 #######################################
 # cafes
@@ -231,6 +604,137 @@ class CafeViewsTestCase(TestCase):
             self.assertIn(b"Test Cafe", resp.data)
             self.assertIn(b'testcafe.com', resp.data)
 
+    def test_detail_not_modified(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            etag = resp.headers["ETag"]
+            self.assertNotIn("Last-Modified", resp.headers)
+
+            resp = client.get(
+                f"/cafes/{self.cafe_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            cafe = Cafe.query.get(self.cafe_id)
+            cafe.name = "Renamed Cafe"
+            db.session.commit()
+
+            resp = client.get(
+                f"/cafes/{self.cafe_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Renamed Cafe", resp.data)
+
+            # as written by another process: no session hooks run here,
+            # but the shared version still expires the cached page
+            db.session.execute(
+                Cafe.__table__.update().values(name="Elsewhere Cafe"))
+            DataVersion.bump(PAGES_VERSION)
+            db.session.commit()
+
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b"Elsewhere Cafe", resp.data)
+
+    def test_export(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes")
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+            rows = [json.loads(line) for line in resp.data.splitlines()]
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0]["name"], "Test Cafe")
+            self.assertEqual(rows[0]["city_code"], "sf")
+
+            resp = client.get("/api/cafes?format=json&city=sf")
+            self.assertEqual([c["id"] for c in resp.json], [self.cafe_id])
+
+            resp = client.get("/api/cafes?city=oak")
+            self.assertEqual(resp.data, b"")
+
+            resp = client.get("/api/cafes?updated_since=2999-01-01")
+            self.assertEqual(resp.data, b"")
+
+            resp = client.get("/api/cafes?updated_since=yesterday")
+            self.assertEqual(resp.status_code, 400)
+
+            # offsets are converted to UTC, which updated_at is stored in
+            Cafe.query.update({"updated_at": datetime(2020, 1, 1, 12)})
+            db.session.commit()
+            resp = client.get(
+                "/api/cafes?updated_since=2020-01-01T16:30:00%2B05:00")
+            self.assertEqual(len(resp.data.splitlines()), 1)
+            resp = client.get("/api/cafes?updated_since=2020-01-01T16:30:00")
+            self.assertEqual(resp.data, b"")
+
+    def test_search(self):
+        db.session.add(Cafe(**{
+            **CAFE_DATA,
+            "name": "Other Place",
+            "description": "Espresso bar",
+        }))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/cafes/search?q=espresso")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Other Place", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+            resp = client.get("/api/cafes/search?q=sansome")
+            names = {cafe["name"] for cafe in resp.json["cafes"]}
+            self.assertEqual(names, {"Test Cafe", "Other Place"})
+            self.assertIsNone(resp.json["next_page"])
+
+            resp = client.get("/api/cafes/search?q=")
+            self.assertEqual(resp.json["cafes"], [])
+
+    def test_nearby(self):
+        cafe = Cafe.query.get(self.cafe_id)
+        cafe.latitude = 37.7946
+        cafe.longitude = -122.4014
+        db.session.add(Cafe(**{
+            **CAFE_DATA,
+            "name": "Oakland Cafe",
+            "latitude": 37.8119,
+            "longitude": -122.2581,
+        }))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/cafes/nearby?lat=37.79&lng=-122.40&radius=2")
+            self.assertEqual(
+                [c["name"] for c in resp.json["cafes"]], ["Test Cafe"])
+
+            resp = client.get("/cafes/nearby?lat=37.80&lng=-122.26&k=2&radius=50")
+            self.assertEqual(
+                [c["name"] for c in resp.json["cafes"]],
+                ["Oakland Cafe", "Test Cafe"])
+
+            resp = client.get("/cafes/nearby?lat=100&lng=0")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_list_pagination(self):
+        db.session.add(Cafe(**{**CAFE_DATA, "name": "Another Cafe"}))
+        db.session.commit()
+
+        app.config['CAFES_PER_PAGE'] = 1
+        try:
+            with app.test_client() as client:
+                resp = client.get("/cafes")
+                self.assertIn(b"Another Cafe", resp.data)
+                self.assertNotIn(b"Test Cafe", resp.data)
+
+                next_url = re.search(
+                    r'href="(/cafes\?after=[^"]+)"',
+                    resp.data.decode('utf8')).group(1)
+                resp = client.get(next_url)
+                self.assertIn(b"Test Cafe", resp.data)
+                self.assertNotIn(b"Another Cafe", resp.data)
+                self.assertIn(b"/cafes?before=", resp.data)
+                self.assertNotIn(b"/cafes?after=", resp.data)
+
+                resp = client.get("/cafes?after=not-a-cursor")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['CAFES_PER_PAGE'] = 24
+
 
 class CafeAdminViewsTestCase(TestCase):
     """Tests for add/edit views on cafes."""
@@ -299,6 +803,140 @@ class CafeAdminViewsTestCase(TestCase):
             self.assertIn(b'edited', resp.data)
 
 
+class ImportCafesTestCase(TestCase):
+    """Tests for the import-cafes command."""
+
+    def setUp(self):
+        """Before each test, start with no cafes or cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        """After each test, remove all cafes, cities and checkpoints."""
+
+        ImportCheckpoint.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_import_csv(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cafes.csv")
+            with open(path, "w") as f:
+                f.write(
+                    "name,address,city_code,city_name,city_state,latitude\n"
+                    "Test Cafe,500 Sansome St,sf,San Francisco,CA,37.79\n"
+                    ",no name,sf,San Francisco,CA,\n"
+                    "Other Cafe,1 Main St,oak,Oakland,CA,\n")
+
+            args = ["import-cafes", path, "--checkpoint", "test-import"]
+            result = app.test_cli_runner(mix_stderr=False).invoke(args=args)
+
+            self.assertIn("Done: 2 cafes imported", result.output)
+            self.assertIn("Row 2: skipped", result.stderr)
+            self.assertEqual(ImportCheckpoint.get("test-import"), 3)
+
+            # committed with the rows, so a rerun has nothing left to do
+            result = app.test_cli_runner(mix_stderr=False).invoke(args=args)
+            self.assertIn("Resuming after row 3", result.output)
+            self.assertIn("Done: 0 cafes imported", result.output)
+
+        self.assertEqual(
+            {c.name for c in Cafe.query}, {"Test Cafe", "Other Cafe"})
+        self.assertEqual(City.query.get("oak").name, "Oakland")
+
+
+class ThumbnailTestCase(TestCase):
+    """Tests for image uploads and thumbnails."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.commit()
+
+        self.image_dir = tempfile.TemporaryDirectory()
+
+        class ThumbnailConfig(TestConfig):
+            THUMBNAILS_ENABLED = True
+            THUMBNAIL_DIR = self.image_dir.name
+
+        self.app = create_app(ThumbnailConfig)
+
+    def tearDown(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+        self.image_dir.cleanup()
+
+    def test_upload(self):
+        png = io.BytesIO()
+        Image.new("RGB", (1200, 800), "brown").save(png, "PNG")
+        png.seek(0)
+
+        with self.app.test_client() as client:
+            client.post(
+                "/cafes/add",
+                data={**CAFE_DATA, "image": (png, "cafe.png")},
+                content_type="multipart/form-data")
+
+            image_url = Cafe.query.one().image_url
+            self.assertRegex(image_url, r"^/images/[0-9a-f]{64}\.png$")
+
+            resp = client.get("/cafes")
+            html = resp.get_data(as_text=True)
+            self.assertIn('<source type="image/webp"', html)
+
+            [thumb_url] = re.findall(r'src="(/images/[\w-]+\.jpg)"', html)
+            resp = client.get(thumb_url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            with Image.open(io.BytesIO(resp.data)) as thumb:
+                self.assertEqual(thumb.size, (320, 213))
+
+    def test_upload_not_image(self):
+        with self.app.test_client() as client:
+            resp = client.post(
+                "/cafes/add",
+                data={**CAFE_DATA, "image": (io.BytesIO(b"hi"), "cafe.png")},
+                content_type="multipart/form-data")
+
+        self.assertIn(b"Upload a JPEG, PNG, GIF or WebP image.", resp.data)
+        self.assertEqual(Cafe.query.count(), 0)
+
+    def test_static_image(self):
+        image_url = "/static/images/default-cafe.jpg"
+
+        with self.app.app_context():
+            # made (inline, in tests) the first time it's asked for
+            self.assertIsNone(thumbnailer.srcsets(image_url, 160))
+            srcsets = thumbnailer.srcsets(image_url, 160)
+
+        self.assertRegex(srcsets["webp"], r"-160\.webp 160w, .*-320\.webp 320w$")
+        self.assertTrue(srcsets["src"].endswith("-160.jpg"))
+
+    def test_fetch_not_public(self):
+        for url in ["http://127.0.0.1/a.jpg",
+                    "http://localhost:5000/a.jpg",
+                    "http://169.254.169.254/latest/meta-data/",
+                    "https://10.0.0.1/a.jpg",
+                    "http://[::1]/a.jpg",
+                    "http://[::ffff:192.168.0.1]/a.jpg",
+                    "ftp://example.com/a.jpg"]:
+            with self.assertRaises(ValueError):
+                fetch_public_url(url, max_bytes=1000)
+
+    def test_queue_full(self):
+        with self.app.app_context():
+            thumbnailer.max_pending = 0
+            thumbnailer.srcsets("/static/images/default-cafe.jpg", 160)
+            # dropped, not made
+            self.assertIsNone(
+                thumbnailer.srcsets("/static/images/default-cafe.jpg", 160))
+
+
 #######################################
 # users
 
@@ -335,6 +973,15 @@ class UserModelTestCase(TestCase):
         rez = User.authenticate("test", "password")
         self.assertEqual(rez, False)
 
+    def test_authenticate_rehash(self):
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        try:
+            rez = User.authenticate("test", "secret")
+            self.assertEqual(rez.hashed_password[:7], "$2b$05$")
+            self.assertEqual(User.authenticate("test", "secret"), self.user)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+
     def test_full_name(self):
         self.assertEqual(self.user.get_full_name(), "Testy MacTest")
 
@@ -344,6 +991,26 @@ class UserModelTestCase(TestCase):
         self.assertEqual(u.hashed_password[:4], "$2b$")
         db.session.rollback()
 
+    def test_username_index(self):
+        now = [0]
+        index = UsernameIndex(max_age=60, timer=lambda: now[0])
+
+        # built on first use (inline, as the test app doesn't use a thread)
+        self.assertTrue(index.might_contain("test"))
+        self.assertFalse(index.might_contain("other"))
+
+        # users written elsewhere are picked up once max_age passes,
+        # without rescanning the ones already added
+        db.session.execute(User.__table__.insert(), dict(
+            username="other", first_name="O", last_name="T",
+            hashed_password="x"))
+        db.session.commit()
+        self.assertFalse(index.might_contain("other"))
+
+        now[0] = 60
+        self.assertTrue(index.might_contain("other"))
+        self.assertEqual(index._filter.count, 2)
+
 
 class AuthViewsTestCase(TestCase):
     """Tests for views on logging in/logging out/registration."""
@@ -382,6 +1049,29 @@ class AuthViewsTestCase(TestCase):
             self.assertIn(b"You are signed up and logged in.", resp.data)
             self.assertTrue(session.get(CURR_USER_KEY))
 
+    def test_signup_taken_username(self):
+        with app.test_client() as client:
+            resp = client.post(
+                "/signup",
+                data={**TEST_USER_DATA_NEW, "username": "test"},
+                follow_redirects=True,
+            )
+            self.assertIn(b"Username already taken.", resp.data)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
+    def test_username_available(self):
+        with app.test_client() as client:
+            resp = client.get("/api/username-available?username=test")
+            self.assertEqual(
+                resp.json, {"username": "test", "available": False})
+
+            resp = client.get("/api/username-available?username=nobody")
+            self.assertEqual(
+                resp.json, {"username": "nobody", "available": True})
+
+            resp = client.get("/api/username-available")
+            self.assertEqual(resp.status_code, 400)
+
     def test_login(self):
         with app.test_client() as client:
             resp = client.get("/login")
@@ -404,6 +1094,71 @@ class AuthViewsTestCase(TestCase):
             self.assertIn(b"Hello, test", resp.data)
             self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
 
+    def test_login_hashing_busy(self):
+        app.config['HASHING_WORKERS'] = 1
+        app.config['HASHING_MAX_QUEUE'] = 0
+        try:
+            # start pool, then take its only slot
+            password_hasher.hash("secret")
+            password_hasher._slots.acquire()
+
+            with app.test_client() as client:
+                resp = client.post(
+                    "/login",
+                    data={"username": "test", "password": "secret"})
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers["Retry-After"], "1")
+
+            password_hasher._slots.release()
+        finally:
+            app.config['HASHING_WORKERS'] = 0
+
+    def test_hashing_broken_pool(self):
+        app.config['HASHING_WORKERS'] = 1
+        try:
+            password_hasher.hash("secret")
+            pool = password_hasher._pool
+
+            # kill the pool's process, as if it crashed
+            for process in list(pool._processes.values()):
+                process.kill()
+                process.join()
+
+            with self.assertRaises(HashingBusy):
+                password_hasher.hash("secret")
+            self.assertIsNone(password_hasher._pool)
+
+            self.assertTrue(password_hasher.check(
+                password_hasher.hash("secret"), "secret"))
+            self.assertIsNot(password_hasher._pool, pool)
+        finally:
+            app.config['HASHING_WORKERS'] = 0
+            if password_hasher._pool is not None:
+                password_hasher._discard(password_hasher._pool)
+
+    def test_login_rate_limit(self):
+        app.config['RATELIMIT_ENABLED'] = True
+        app.config['RATELIMITS'] = {'login': '2/minute'}
+        try:
+            with app.test_client() as client:
+                for _ in range(2):
+                    resp = client.post(
+                        "/login",
+                        data={"username": "test", "password": "WRONG"})
+                    self.assertEqual(resp.status_code, 200)
+
+                resp = client.post(
+                    "/login", data={"username": "test", "password": "WRONG"})
+                self.assertEqual(resp.status_code, 429)
+                self.assertEqual(resp.headers["Retry-After"], "30")
+
+                # only POSTs are limited
+                resp = client.get("/login")
+                self.assertEqual(resp.status_code, 200)
+        finally:
+            app.config['RATELIMIT_ENABLED'] = False
+            app.config['RATELIMITS'] = TestConfig.RATELIMITS
+
     def test_logout(self):
         with app.test_client() as client:
             do_login(client, self.user_id)
@@ -504,6 +1259,8 @@ class ProfileViewsTestCase(TestCase):
                 data=TEST_USER_DATA_EDIT,
                 follow_redirects=True)
             self.assertIn(b'Profile edited', resp.data)
+            # cached identity is refreshed after edit
+            self.assertIn(b'new-fn new-ln', resp.data)
 
 
 #######################################
@@ -511,39 +1268,395 @@ class ProfileViewsTestCase(TestCase):
 
 
 class LikeViewsTestCase(TestCase):
-    """Tests for views on cafes."""
+    """Tests for views on likes."""
 
-    # def setUp(self):
-    #     """Before each test, add sample user."""
-        
-    #     User.query.delete()
-    #     City.query.delete()
-    #     Cafe.query.delete()
+    def setUp(self):
+        """Before each test, add sample city, cafes and user."""
 
-    #     sf = City(**CITY_DATA)
-    #     db.session.add(sf)
+        SimilarCafe.query.delete()
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
 
-    #     cafe = Cafe(**CAFE_DATA)
-    #     db.session.add(cafe)
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
 
-    #     user = User.register(**TEST_USER_DATA)
-    #     db.session.add(user)
-    #     db.session.commit()
+        cafe = Cafe(**CAFE_DATA)
+        other_cafe = Cafe(**{**CAFE_DATA, "name": "Other Cafe"})
+        db.session.add_all([cafe, other_cafe])
 
-    #     self.user = user
-    #     self.user_id = user.id
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+        db.session.commit()
 
-    #     db.session.commit()
+        db.session.add(Like(cafe_id=cafe.id, user_id=user.id))
+        db.session.commit()
 
-    # def tearDown(self):
-    #     """After each test, remove all users."""
+        self.cafe_id = cafe.id
+        self.other_cafe_id = other_cafe.id
+        self.user_id = user.id
 
-    #     User.query.delete()
-    #     db.session.commit()
-    
-    # def test_liked_cafe(self):
-    #     with app.test_client() as client:
-    #         #like a cafe
-    #         user.liked_cafes.append(cafe)
-    #         db.session.commit()
+    def tearDown(self):
+        """After each test, remove likes, users and cafes."""
+
+        SimilarCafe.query.delete()
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_like_count(self):
+        def like_counts():
+            db.session.expire_all()
+            return (Cafe.query.get(self.cafe_id).like_count,
+                    Cafe.query.get(self.other_cafe_id).like_count)
+
+        self.assertEqual(like_counts(), (1, 0))
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            client.post("/api/like", json={"cafe_id": self.other_cafe_id})
+            client.post("/api/like", json={"cafe_id": self.other_cafe_id})
+            self.assertEqual(like_counts(), (1, 1))
+
+            client.post("/api/unlike", json={"cafe_id": self.cafe_id})
+            self.assertEqual(like_counts(), (0, 1))
+
+            client.post("/api/likes/bulk", json={
+                "like": [self.cafe_id], "unlike": [self.other_cafe_id]})
+            self.assertEqual(like_counts(), (1, 0))
+
+            # most liked first
+            app.config['CAFES_PER_PAGE'] = 1
+            try:
+                resp = client.get("/cafes?sort=popular")
+                self.assertIn(b"Test Cafe", resp.data)
+                next_url = re.search(
+                    r'href="(/cafes\?after=[^"]+)"',
+                    resp.data.decode('utf8')).group(1)
+                resp = client.get(next_url.replace("&amp;", "&"))
+                self.assertIn(b"Other Cafe", resp.data)
+            finally:
+                app.config['CAFES_PER_PAGE'] = 24
+
+    def test_top_cafes(self):
+        def top(query=""):
+            resp = client.get(f"/api/cafes/top{query}")
+            return [cafe["name"] for cafe in resp.json["cafes"]]
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            self.assertEqual(top(), ["Test Cafe"])
+
+            client.post("/api/like", json={"cafe_id": self.other_cafe_id})
+            # equal counts: lowest id first
+            self.assertEqual(top(), ["Test Cafe", "Other Cafe"])
+
+            client.post("/api/unlike", json={"cafe_id": self.cafe_id})
+            self.assertEqual(top(), ["Other Cafe"])
+            self.assertEqual(top("?city=sf"), ["Other Cafe"])
+
+            resp = client.get("/api/cafes/top?city=nope")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get("/")
+            self.assertIn(b"Most liked", resp.data)
+
+    def test_top_cities(self):
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        oak_cafe = Cafe(**{**CAFE_DATA, "city_code": "oak"})
+        other_user = User.register(
+            **{**TEST_USER_DATA, "username": "other",
+               "email": "other@test.com"})
+        db.session.add_all([oak_cafe, other_user])
+        db.session.commit()
+        db.session.add_all([
+            Like(cafe_id=oak_cafe.id, user_id=self.user_id),
+            Like(cafe_id=oak_cafe.id, user_id=other_user.id)])
+        db.session.commit()
+        leaderboard.invalidate()
+
+        self.assertEqual(leaderboard.top_cities(5), ["oak", "sf"])
+
+        app.config['TOP_CITIES_SHOWN'] = 1
+        try:
+            with app.test_client() as client:
+                html = client.get("/").get_data(as_text=True)
+                self.assertIn("<h6>Oakland</h6>", html)
+                self.assertNotIn("<h6>San Francisco</h6>", html)
+
+                html = client.get("/?city=sf").get_data(as_text=True)
+                self.assertIn("<h6>San Francisco</h6>", html)
+                self.assertNotIn("<h6>Oakland</h6>", html)
+        finally:
+            app.config['TOP_CITIES_SHOWN'] = 6
+
+    def test_leaderboard_bounded(self):
+        board = Leaderboard(size=1, headroom=0)
+        self.assertEqual([cafe.id for cafe in board.top()], [self.cafe_id])
+        self.assertEqual(len(board._rankings[None].entries), 1)
+
+        Like.query.delete()
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.other_cafe_id))
+        db.session.commit()
+
+        # the top cafe dropped out, and nothing known can replace it...
+        board.refresh([self.cafe_id])
+        self.assertEqual(board._rankings[None].entries, [])
+        self.assertIsNone(board._loaded_at)
+        # ...so it's reloaded on next use
+        self.assertEqual(
+            [cafe.id for cafe in board.top()], [self.other_cafe_id])
+
+    def test_similar_cafes(self):
+        # likers: 10 and 20 by users 1 and 2, 30 by user 1
+        similar = similar_cafes(
+            [(1, 10), (1, 20), (1, 30), (2, 10), (2, 20)], top_k=1)
+        self.assertEqual(similar[10], [(20, 1.0)])
+        [(cafe_id, score)] = similar[30]
+        self.assertEqual(cafe_id, 10)
+        self.assertAlmostEqual(score, 2 ** -.5)
+
+        other_user = User.register(**{
+            **TEST_USER_DATA, "username": "other", "email": "o@test.com"})
+        db.session.add(other_user)
+        db.session.commit()
+        db.session.add_all([
+            Like(cafe_id=self.cafe_id, user_id=other_user.id),
+            Like(cafe_id=self.other_cafe_id, user_id=other_user.id),
+        ])
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["refresh-similar-cafes"])
+        self.assertIn("Done: 2 cafes changed", result.output)
+        result = runner.invoke(args=["refresh-similar-cafes"])
+        self.assertIn("Done: 0 cafes changed", result.output)
+
+        with app.test_client() as client:
+            resp = client.get(f"/api/cafes/{self.cafe_id}/similar")
+            cafes = resp.json["cafes"]
+            self.assertEqual([c["name"] for c in cafes], ["Other Cafe"])
+            self.assertAlmostEqual(cafes[0]["score"], 2 ** -.5)
+
+            resp = client.get(f"/api/cafes/{self.cafe_id + 1000}/similar")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = client.get(f"/cafes/{self.other_cafe_id}")
+            self.assertIn(b"People who like Other Cafe also like", resp.data)
+
+    def test_reconcile_like_counts(self):
+        Cafe.query.update({"like_count": 5})
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["reconcile-like-counts"])
+        self.assertIn("Done: 2 cafe like counts fixed", result.output)
+
+        db.session.expire_all()
+        self.assertEqual(Cafe.query.get(self.cafe_id).like_count, 1)
+        self.assertEqual(Cafe.query.get(self.other_cafe_id).like_count, 0)
+
+    def test_upgrade_db(self):
+        # as a database from before like counts
+        db.session.execute("DROP INDEX ix_cafes_like_count_desc_id")
+        db.session.execute("DROP TRIGGER likes_like_count_insert")
+        db.session.execute("DROP TABLE similar_cafes")
+        db.session.execute(
+            "CREATE INDEX ix_cafes_like_count_id ON cafes (like_count, id)")
+        # ...and before full-text search
+        for trigger in ("insert", "delete", "update"):
+            db.session.execute(f"DROP TRIGGER cafes_fts_{trigger}")
+        db.session.execute("DROP TABLE cafes_fts")
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["upgrade-db"])
+        self.assertIn("created table similar_cafes", result.output)
+        self.assertIn("dropped index ix_cafes_like_count_id", result.output)
+        self.assertIn(
+            "created index ix_cafes_like_count_desc_id", result.output)
+
+        # existing cafes are searchable
+        resp = app.test_client().get("/api/cafes/search?q=sansome")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.json["cafes"]), 2)
+
+        # likes bump the count, and updated_at for incremental exports
+        Cafe.query.update({"updated_at": datetime(2000, 1, 1)})
+        db.session.add(Like(cafe_id=self.other_cafe_id, user_id=self.user_id))
+        db.session.commit()
+
+        db.session.expire_all()
+        cafe = Cafe.query.get(self.other_cafe_id)
+        self.assertEqual(cafe.like_count, 1)
+        self.assertGreater(cafe.updated_at, datetime(2000, 1, 1))
+
+    def test_my_likes(self):
+        # liked after the setUp like, so comes first
+        db.session.add(Like(cafe_id=self.other_cafe_id, user_id=self.user_id,
+                            created_at=datetime(2100, 1, 1)))
+        db.session.commit()
+        app.config['LIKES_PER_PAGE'] = 1
+
+        try:
+            with app.test_client() as client:
+                do_login(client, self.user_id)
+
+                resp = client.get("/api/users/me/likes")
+                [like] = resp.json["likes"]
+                self.assertEqual(like["id"], self.other_cafe_id)
+                self.assertEqual(like["liked_at"], "2100-01-01T00:00:00")
+
+                cursor = resp.json["next_cursor"]
+                resp = client.get(f"/api/users/me/likes?after={cursor}")
+                [like] = resp.json["likes"]
+                self.assertEqual(like["id"], self.cafe_id)
+                self.assertIsNone(resp.json["next_cursor"])
+
+                resp = client.get(f"/profile?after={cursor}")
+                self.assertIn(f'href="/cafes/{self.cafe_id}"', resp.data.decode())
+                self.assertNotIn(b"More liked cafes", resp.data)
+
+                resp = client.get("/api/users/me/likes?after=nope")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['LIKES_PER_PAGE'] = TestConfig.LIKES_PER_PAGE
+
+    def test_anon_likes(self):
+        with app.test_client() as client:
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"error": "Not logged in"})
+
+    def test_detail_like_state(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn('<span id="like-count">1</span>', html)
+            self.assertRegex(html, r'btn-outline-primary">\s*Like\s*<')
+
+            do_login(client, self.user_id)
+
+            # within budget even with the user and city registry to load
+            user_cache.clear()
+            city_registry.invalidate()
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertRegex(
+                resp.get_data(as_text=True), r'btn-primary">\s*Liked\s*<')
+
+            resp = client.get(f"/cafes/{self.other_cafe_id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn('<span id="like-count">0</span>', html)
+            self.assertRegex(html, r'btn-outline-primary">\s*Like\s*<')
+
+    def test_likes(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": True})
+
+            resp = client.get(f"/api/likes?cafe_id={self.other_cafe_id}")
+            self.assertEqual(resp.json, {"likes": False})
+
+    def test_likes_batch(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            resp = client.get(
+                f"/api/likes?cafe_ids={self.cafe_id},{self.other_cafe_id}")
+            self.assertEqual(resp.json, {"likes": {
+                str(self.cafe_id): True,
+                str(self.other_cafe_id): False,
+            }})
+
+            resp = client.get("/api/likes?cafe_ids=1,two")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_like_twice(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            for _ in range(2):
+                resp = client.post(
+                    "/api/like", json={"cafe_id": self.cafe_id})
+                self.assertEqual(resp.json, {"liked": self.cafe_id})
+
+            self.assertEqual(
+                Like.query.filter_by(user_id=self.user_id).count(), 1)
+
+    def test_bulk_likes(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            resp = client.post("/api/likes/bulk", json={
+                "like": [self.other_cafe_id, self.other_cafe_id],
+                "unlike": [self.cafe_id],
+            })
+            self.assertEqual(resp.json, {
+                "liked": [self.other_cafe_id],
+                "unliked": [self.cafe_id],
+            })
+
+            def liked_ids():
+                return {like.cafe_id for like
+                        in Like.query.filter_by(user_id=self.user_id)}
+
+            self.assertEqual(liked_ids(), {self.other_cafe_id})
+
+            resp = client.post("/api/likes/bulk", json={
+                "like": [self.cafe_id],
+                "unlike": [self.cafe_id],
+            })
+            self.assertEqual(resp.status_code, 400)
+
+            # not lists of ints (a string isn't iterated per character)
+            for data in [{"like": "12"}, {"like": [1.5]}, {"unlike": [True]},
+                         {"like": [str(self.cafe_id)]}, [self.cafe_id]]:
+                resp = client.post("/api/likes/bulk", json=data)
+                self.assertEqual(resp.status_code, 400)
+
+            # unknown cafes fail the whole request
+            resp = client.post("/api/likes/bulk", json={
+                "like": [self.cafe_id, 0]})
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.json["cafe_ids"], [0])
+            self.assertEqual(liked_ids(), {self.other_cafe_id})
+
+            resp = client.post("/api/like", json={"cafe_id": 0})
+            self.assertEqual(resp.status_code, 404)
+            resp = client.post("/api/like", json={"cafe_id": "x"})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_read_your_writes(self):
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_REPLICA_URIS = [TestConfig.SQLALCHEMY_DATABASE_URI]
+
+        replica_app = create_app(ReplicaConfig)
+        primary = db.get_engine(replica_app)
+        replica = db.get_engine(replica_app, bind="replica_0")
+        self.assertIsNot(primary, replica)
+
+        with replica_app.test_client() as client:
+            do_login(client, self.user_id)
+
+            # still in the request's context: reads go to the replica...
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": True})
+            self.assertNotIn(PRIMARY_UNTIL_KEY, session)
+            self.assertIs(db.session.get_bind(), replica)
+
+            # ...except for caches shared by every client
+            with reading_primary():
+                self.assertIs(db.session.get_bind(), primary)
+            self.assertIs(db.session.get_bind(), replica)
+
+            # after a write, reads stay on the primary
+            client.post("/api/like", json={"cafe_id": self.other_cafe_id})
+            self.assertIn(PRIMARY_UNTIL_KEY, session)
+            self.assertIs(db.session.get_bind(), primary)
 
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertIs(db.session.get_bind(), primary)
@@ -0,0 +1,407 @@
+"""Image thumbnails for Flask Cafe.
+
+Cafe and user images are full-size originals (often on other sites), far
+bigger than the cards they're shown in. The first time a page shows an
+image, it's queued for a background worker that fetches it and writes
+WebP and JPEG thumbnails at each of THUMBNAIL_WIDTHS. Until they're ready,
+pages just use the original, so no request ever waits on resizing.
+
+Files are named by the SHA-256 of the original's bytes, so never change
+once written, and are served from /images/ with immutable cache headers.
+A small index (in THUMBNAIL_DIR/sources/) maps image URLs to those hashes.
+
+Uploaded images are stored the same way; save_upload() returns the URL
+to use as the image_url.
+
+Image URLs are user input, so fetching one mustn't reach anything on our
+own network: the host is resolved once, any address that isn't public
+(private, loopback, link-local, reserved...) is refused, the connection
+goes to exactly the address checked, and redirects aren't followed. At
+most THUMBNAIL_MAX_PENDING images wait to be thumbnailed; more are
+dropped (and retried when next shown).
+
+Needs Pillow (imported only when first used).
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import logging
+import os
+import re
+import socket
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+from werkzeug.security import safe_join
+
+from cache import LRUCache
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+FORMATS = (("WEBP", "webp"), ("JPEG", "jpg"))
+
+# file extensions for originals we accept, by Pillow's name for the format
+UPLOAD_FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif", "WEBP": "webp"}
+
+# names of files we write, so /images/ can't serve anything else
+IMAGE_NAME_RE = re.compile(r"^[0-9a-f]{64}(-\d+)?\.(webp|jpg|png|gif)$")
+
+URL_PREFIX = "/images/"
+
+thumbnails_made = registry.counter(
+    'flaskcafe_thumbnails_total',
+    'Images thumbnailed, by whether it worked (or was dropped, when too '
+    'many were queued).',
+    ['result'])
+
+
+def public_address(host, port):
+    """Return an IP address host resolves to, refusing (ValueError) if
+    any of its addresses isn't a public one.
+    """
+
+    try:
+        infos = socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        raise ValueError(f"Can't resolve {host}")
+
+    addresses = []
+    for *_, sockaddr in infos:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if getattr(address, "ipv4_mapped", None):
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"{host} isn't a public address")
+        addresses.append(str(address))
+
+    if not addresses:
+        raise ValueError(f"Can't resolve {host}")
+    return addresses[0]
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection to a given address, whatever host now resolves to."""
+
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection(
+            (self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection to a given address, verifying host's certificate."""
+
+    def __init__(self, host, port, address, timeout):
+        self.ssl_context = ssl.create_default_context()
+        super().__init__(
+            host, port, timeout=timeout, context=self.ssl_context)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection(
+            (self.address, self.port), self.timeout)
+        self.sock = self.ssl_context.wrap_socket(
+            sock, server_hostname=self.host)
+
+
+def fetch_public_url(url, max_bytes, timeout=10):
+    """Return body of a GET of http(s) url, if its host is public (see
+    public_address), it answers 200 (redirects aren't followed) and the
+    body is at most max_bytes.
+    """
+
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("Unsupported image url")
+
+    https = parts.scheme == "https"
+    port = parts.port or (443 if https else 80)
+    address = public_address(parts.hostname, port)
+
+    if https:
+        connection = _PinnedHTTPSConnection(
+            parts.hostname, port, address, timeout)
+    else:
+        connection = _PinnedHTTPConnection(
+            parts.hostname, port, address, timeout)
+    try:
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        connection.request("GET", path)
+        response = connection.getresponse()
+        if response.status != 200:
+            raise ValueError(f"Got HTTP {response.status}")
+
+        data = response.read(max_bytes + 1)
+    finally:
+        connection.close()
+
+    if len(data) > max_bytes:
+        raise ValueError("Image too large")
+    return data
+
+
+def image_format(stream):
+    """Return Pillow's name for the format of the image in stream (which
+    is left at its start), or None if it isn't a supported image.
+    """
+
+    from PIL import Image
+
+    try:
+        with Image.open(stream) as image:
+            name = image.format
+    except Exception:
+        name = None
+    finally:
+        stream.seek(0)
+
+    return name if name in UPLOAD_FORMATS else None
+
+
+def make_thumbnails(data, directory, key, widths, quality):
+    """Write WebP and JPEG thumbnails of image data, at each of widths, as
+    <key>-<width>.<ext> in directory.
+    """
+
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+
+    for width in widths:
+        thumbnail = image.copy()
+        # only ever shrinks, keeping the aspect ratio
+        thumbnail.thumbnail((width, width * 4), Image.LANCZOS)
+
+        for format_name, extension in FORMATS:
+            path = os.path.join(directory, f"{key}-{width}.{extension}")
+            tmp_path = f"{path}.tmp"
+            thumbnail.save(tmp_path, format_name, quality=quality)
+            os.replace(tmp_path, path)
+
+
+class Thumbnailer:
+    """Makes and finds thumbnails of images, in a background thread pool."""
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.static_folder = None
+        self.static_url_path = None
+        self.widths = ()
+        self.quality = 80
+        self.workers = 0
+        self.max_bytes = 10 * 1024 * 1024
+        self.max_pending = 100
+
+        # image url -> hash of its bytes
+        self._keys = LRUCache(maxsize=10000)
+        # image urls that couldn't be thumbnailed; retried once expired
+        self._failed = LRUCache(maxsize=10000, ttl=60 * 60)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+
+    def init_app(self, app):
+        """Configure from app's config."""
+
+        self.enabled = app.config['THUMBNAILS_ENABLED']
+        self.directory = app.config['THUMBNAIL_DIR'] or os.path.join(
+            app.instance_path, 'thumbnails')
+        self.static_folder = app.static_folder
+        self.static_url_path = app.static_url_path
+        self.widths = tuple(sorted(app.config['THUMBNAIL_WIDTHS']))
+        self.quality = app.config['THUMBNAIL_QUALITY']
+        self.workers = app.config['THUMBNAIL_WORKERS']
+        self.max_bytes = app.config['THUMBNAIL_MAX_BYTES']
+        self.max_pending = app.config['THUMBNAIL_MAX_PENDING']
+        self._keys.clear()
+        self._failed.clear()
+
+    def srcsets(self, image_url, width):
+        """Return {"src": url, "webp": srcset, "jpeg": srcset} of thumbnails
+        of image_url for showing about width pixels wide (or None, queueing
+        them to be made, if there aren't any yet).
+        """
+
+        if not self.enabled or not image_url:
+            return None
+
+        key = self._key(image_url)
+        if key is None:
+            self._queue(image_url)
+            return None
+
+        # enough for screens of up to 2x pixel density
+        larger = [w for w in self.widths if w >= width * 2]
+        widths = [w for w in self.widths if w < width * 2] + larger[:1]
+        src_width = next((w for w in widths if w >= width), widths[-1])
+
+        def srcset(extension):
+            return ", ".join(
+                f"{URL_PREFIX}{key}-{w}.{extension} {w}w" for w in widths)
+
+        return {
+            "src": f"{URL_PREFIX}{key}-{src_width}.jpg",
+            "webp": srcset("webp"),
+            "jpeg": srcset("jpg"),
+        }
+
+    def save_upload(self, upload):
+        """Store an uploaded image (a werkzeug FileStorage, checked by
+        image_format()) and queue its thumbnails; return its URL.
+        """
+
+        upload_format = image_format(upload.stream)
+        data = upload.read(self.max_bytes + 1)
+        if len(data) > self.max_bytes:
+            raise ValueError("Image too large")
+
+        key = hashlib.sha256(data).hexdigest()
+        name = f"{key}.{UPLOAD_FORMATS[upload_format]}"
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        image_url = f"{URL_PREFIX}{name}"
+        if self.enabled:
+            self._queue(image_url, data)
+        return image_url
+
+    def path(self, name):
+        """Return path of image file called name, or None if none."""
+
+        if not self.directory or not IMAGE_NAME_RE.match(name):
+            return None
+
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def _source_path(self, image_url):
+        digest = hashlib.sha256(image_url.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, "sources", digest)
+
+    def _key(self, image_url):
+        """Return hash of image_url's thumbnailed bytes, or None if it
+        hasn't been thumbnailed.
+        """
+
+        key = self._keys.get(image_url)
+        if key is None:
+            try:
+                with open(self._source_path(image_url)) as f:
+                    key = f.read().strip()
+            except FileNotFoundError:
+                return None
+            self._keys.set(image_url, key)
+        return key
+
+    def _queue(self, image_url, data=None):
+        """Thumbnail image_url in the background (inline, with no workers),
+        unless it's already queued, recently failed or the queue is full.
+        """
+
+        with self._lock:
+            if image_url in self._pending or self._failed.get(image_url):
+                return
+            if len(self._pending) >= self.max_pending:
+                thumbnails_made.labels('dropped').inc()
+                return
+            self._pending.add(image_url)
+
+            if self.workers:
+                # a forked worker process can't use its parent's threads
+                if self._pool is None or self._pool_pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(
+                        max_workers=self.workers,
+                        thread_name_prefix="thumbnailer")
+                    self._pool_pid = os.getpid()
+                pool = self._pool
+            else:
+                pool = None
+
+        if pool is None:
+            self._thumbnail(image_url, data)
+        else:
+            pool.submit(self._thumbnail, image_url, data)
+
+    def _thumbnail(self, image_url, data=None):
+        """Make thumbnails of image_url and add it to the index."""
+
+        try:
+            if data is None:
+                data = self._fetch(image_url)
+
+            key = hashlib.sha256(data).hexdigest()
+            os.makedirs(os.path.join(self.directory, "sources"), exist_ok=True)
+            if not os.path.exists(os.path.join(
+                    self.directory, f"{key}-{self.widths[-1]}.jpg")):
+                make_thumbnails(
+                    data, self.directory, key, self.widths, self.quality)
+
+            path = self._source_path(image_url)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(key)
+            os.replace(tmp_path, path)
+
+            self._keys.set(image_url, key)
+            thumbnails_made.labels('ok').inc()
+        except Exception:
+            logger.warning("Couldn't thumbnail %s", image_url, exc_info=True)
+            self._failed.set(image_url, True)
+            thumbnails_made.labels('failed').inc()
+        finally:
+            with self._lock:
+                self._pending.discard(image_url)
+
+    def _fetch(self, image_url):
+        """Return bytes of image at image_url (which may be one of ours)."""
+
+        if image_url.startswith(URL_PREFIX):
+            path = self.path(image_url[len(URL_PREFIX):])
+        elif image_url.startswith(self.static_url_path + "/"):
+            path = safe_join(
+                self.static_folder,
+                image_url[len(self.static_url_path) + 1:])
+        elif image_url.startswith(("http://", "https://")):
+            return fetch_public_url(image_url, self.max_bytes)
+        else:
+            raise ValueError("Unsupported image url")
+
+        if path is None:
+            raise ValueError("No such image")
+        with open(path, "rb") as f:
+            return f.read()
+
+
+# the current app's Thumbnailer
+thumbnailer = LocalProxy(lambda: current_app.extensions['thumbnailer'])
+
+
+def init_app(app):
+    """Give app a Thumbnailer (configured from its config) and the
+    thumbnail_srcsets() template global.
+    """
+
+    app_thumbnailer = app.extensions['thumbnailer'] = Thumbnailer()
+    app_thumbnailer.init_app(app)
+    app.add_template_global(app_thumbnailer.srcsets, 'thumbnail_srcsets')